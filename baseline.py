@@ -0,0 +1,176 @@
+'''
+Build the tripwire databases of hosts from a local copy of their
+filesystem - a mounted golden image, or a directory tree - rather than from
+a scan of the live hosts.
+
+The copy is walked the way the remote find walks a host: the regular files
+on the filesystem of SCAN_ROOT, with the excluded directories pruned and
+the excluded files skipped, named as they are on the host and escaped the
+way the sum program escapes them. A pool of processes, one per core by
+default, hashes a batch of files per task while the walk goes on - small
+files in a single read, big ones memory mapped. The hosts whose platforms
+walk the copy the same way and hash with the same algorithm share a pass.
+
+The databases have no metadata, the inodes and ctimes of the copy aren't
+the host's, so an incremental host hashes everything on its next run.
+
+Usage:
+
+builder = BaselineBuilder('/mnt/golden')
+status, message = builder.build(host_config)    # see fleet
+'''
+
+import hashlib
+import mmap
+from multiprocessing import Pool
+from operator import itemgetter
+import os
+from time import time
+
+import fleet
+import log
+import metrics
+from sumparse import escape_name
+from tripwire import TripwireDatabase
+l = log.getLogger(__name__)
+
+
+BATCH_FILES = 256
+BATCH_BYTES = 64 * 1024 * 1024
+MMAP_MIN_BYTES = 1024 * 1024
+BYTES_PER_MB = 1024 * 1024
+
+
+def _hash_file(path, hash_name):
+    '''the hex digest of the file'''
+    with open(path, 'rb') as hashed_file:
+        if os.fstat(hashed_file.fileno()).st_size < MMAP_MIN_BYTES:
+            return hashlib.new(hash_name, hashed_file.read()).hexdigest()
+        with mmap.mmap(hashed_file.fileno(), 0,
+                       access=mmap.ACCESS_READ) as data:
+            return hashlib.new(hash_name, data).hexdigest()
+
+
+def _hash_batch(task):
+    '''
+    hash a (hashlib name, hex digits kept, [(file_name, path)...]) task in
+    a pool process. Returns the (file_name, file_sum, None) tuples, and the
+    (path, error) tuples of the files that could not be read - which are
+    left out, like the sum program leaves them out.
+    '''
+    hash_name, digits, files = task
+    entries = list()
+    errors = list()
+    for name, path in files:
+        try:
+            file_sum = _hash_file(path, hash_name)
+        except (OSError, ValueError) as error:
+            errors.append((path, str(error)))
+            continue
+        entries.append((name, file_sum[:digits].encode('ascii'), None))
+    return entries, errors
+
+
+def _walk(image, root, pruned):
+    '''
+    yield the (file_name, path, size) tuples of the regular files under
+    root on the copy, not descending into the pruned directories (names)
+    or into other filesystems
+    '''
+    top = os.path.join(image, root.lstrip('/'))
+    device = os.lstat(top).st_dev
+    directories = [(os.fsencode(root.rstrip('/')), top)]
+    while directories:
+        dir_name, dir_path = directories.pop()
+        try:
+            dir_entries = list(os.scandir(dir_path))
+        except OSError as error:
+            l.warning("Skipping %s: %s", dir_path, error)
+            continue
+        for entry in dir_entries:
+            name = dir_name + b'/' + os.fsencode(entry.name)
+            if entry.is_dir(follow_symlinks=False):
+                if (name not in pruned and
+                        entry.stat(follow_symlinks=False).st_dev == device):
+                    directories.append((name, entry.path))
+            elif entry.is_file(follow_symlinks=False):
+                yield name, entry.path, entry.stat(
+                    follow_symlinks=False).st_size
+
+
+class BaselineBuilder:
+    '''
+    write the databases of hosts from the copy of their filesystem in
+    image, hashed by jobs processes (one per core by default)
+    '''
+    def __init__(self, image, jobs=None):
+        self.image = image
+        self.jobs = jobs or os.cpu_count()
+        # (root, algorithm, excludes) --> the sorted entries of the copy
+        self._entries = dict()
+
+    def build(self, host_config):
+        '''
+        (re)write the host's database, returns a (status, message) tuple,
+        see fleet
+        '''
+        twdb = TripwireDatabase(None, host_config.host, host_config.platform)
+        algorithm = twdb.offline_algorithm()
+        platform = host_config.platform.configure(dict(hash=algorithm))
+        key = (platform.SCAN_ROOT, algorithm, platform.excludes())
+        entries = self._entries.get(key)
+        if entries is None:
+            entries = self._entries[key] = self._hash_copy(platform)
+        else:
+            l.info("Reusing the %d sums of %s", len(entries), self.image)
+        twdb.import_database(entries, algorithm)
+        return fleet.UPDATED, "{} files from {}".format(
+            len(entries), self.image)
+
+    def _hash_copy(self, platform):
+        '''the sorted (file_name, file_sum, None) tuples of the copy'''
+        _program, hash_name, digits = platform.hash_algorithm()
+        _exclude_files, exclude_dirs = platform.excludes()
+        pruned = set(os.fsencode(dir_name.rstrip('/'))
+                     for dir_name in exclude_dirs)
+        is_excluded = platform.exclude_pattern().match
+        total = [0, 0]
+
+        def _tasks():
+            batch, size = list(), 0
+            for name, path, file_size in _walk(self.image, platform.SCAN_ROOT,
+                                               pruned):
+                name = escape_name(name)
+                if is_excluded(name):
+                    continue
+                batch.append((name, path))
+                size += file_size
+                if len(batch) >= BATCH_FILES or size >= BATCH_BYTES:
+                    yield hash_name, digits, batch
+                    total[0] += len(batch)
+                    total[1] += size
+                    batch, size = list(), 0
+            if batch:
+                yield hash_name, digits, batch
+                total[0] += len(batch)
+                total[1] += size
+
+        l.info("Hashing %s under %s with %s, %d processes", self.image,
+               platform.SCAN_ROOT, hash_name, self.jobs)
+        started = time()
+        entries = list()
+        with metrics.phase('local_hash'), Pool(self.jobs) as pool:
+            # the walk goes on in the pool's thread feeding it the tasks
+            for batch_entries, errors in pool.imap_unordered(_hash_batch,
+                                                             _tasks()):
+                entries.extend(batch_entries)
+                for path, error in errors:
+                    l.warning("Could not hash %s: %s", path, error)
+        with metrics.phase('sort'):
+            entries.sort(key=itemgetter(0))
+        seconds = max(time() - started, 1e-6)
+        l.info("Hashed %d files, %.1f MB in %.1f seconds (%.1f MB/s)",
+               total[0], total[1] / BYTES_PER_MB, seconds,
+               total[1] / BYTES_PER_MB / seconds)
+        metrics.count('files', len(entries))
+        return entries
@@ -0,0 +1,560 @@
+'''
+End to end benchmark against a local stand-in for the remote end.
+
+A paramiko SSH server that, like dropbear in the initramfs, only runs exec
+requests (no shell, no pty, no subsystems), is started as a subprocess on
+the loopback interface. A synthetic directory tree is generated for it to
+scan, and the client drives DBSSHClient.send_file and the TripwireDatabase
+phases against it, reporting for each phase:
+
+    wall time, files/s, MB/s (of the bytes on the wire), peak RSS of the
+    client process and the bytes sent and received on the SSH socket
+
+Results can be stored as a baseline, and later runs are flagged when a
+phase is slower, bigger or chattier than its baseline by more than the
+tolerance. The sums are streamed, so get_remote_sums only starts the remote
+command and most of the remote work is timed in the phase that reads them.
+Once the phases are done, a file whose name ends in a space is deleted and
+the database is updated and compared again - a round trip through the
+journal (journal=yes) or the layer overlay (db_format=layered). A fresh
+known hosts file is also checked to get the server's key written back, and
+timed as host_key_save, by the first connection of the host's run.
+
+Usage:
+
+python benchmark.py [files=N] [send_mb=N] [work=directory] [seed=N]
+                    [baseline=file] [save] [tolerance=0.25]
+                    [platform settings, e.g. hash_jobs=4 merkle=yes
+                     db_format=layered]
+
+The exit code is non-zero if there was a regression.
+
+python benchmark.py parse[=lines] [work=directory]
+
+times parsing a sums listing and a text database of that many lines (a
+million by default) a chunk at a time, see sumparse, against parsing them a
+line at a time - the best of PARSE_RUNS runs each.
+'''
+
+from collections import OrderedDict
+import hashlib
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import threading
+from time import time
+
+import paramiko
+
+from metrics import recording
+import platforms
+from safestart import HostConfig, parse_arguments
+from sshpool import ConnectionPool
+from sumparse import iter_chunks, parse_chunk
+from sshstuff import DBSSHClient, AutoAddPolicy
+from tripwire import OVERLAY_FILENAME_PATTERN, TripwireDatabase
+
+import log
+l = log.getLogger(__name__)
+
+
+DEFAULT_FILES = 10000
+DEFAULT_SEND_MB = 16
+DEFAULT_WORK_DIR = 'benchmark.work'
+DEFAULT_BASELINE = 'benchmark.baseline.json'
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_SEED = 1
+FILES_PER_DIR = 100
+DIRS_PER_DIR = 32
+MAX_FILE_SIZE = 4096
+SERVER_BUF_SIZE = 32768
+BENCH_HOST = 'benchhost'
+# names the sum program escapes, and one with trailing whitespace that is
+# deleted once the benchmark is done - in every tree
+ODD_NAMES = ('back\\slash', 'new\nline', 'both\\n\n', 'trail ')
+DELETED_NAME = 'trail '
+# what gets compared to the baseline
+REGRESSION_METRICS = ('wall_time', 'peak_rss', 'bytes_sent', 'bytes_received')
+BENCH_ARGS = ('files', 'send_mb', 'work', 'seed', 'baseline', 'save',
+              'tolerance', 'serve')
+DEFAULT_PARSE_LINES = 1000000
+PARSE_RUNS = 3
+
+
+class ExecOnlyServer(paramiko.ServerInterface):
+    '''
+    accepts any public key and runs exec requests with /bin/sh - and
+    nothing else, like dropbear
+    '''
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=_run_command, args=(channel, command),
+                         daemon=True).start()
+        return True
+
+
+def _run_command(channel, command):
+    '''run the command, connecting its stdin, stdout and stderr to channel'''
+    process = subprocess.Popen(['/bin/sh', '-c', command],
+                               bufsize=0,
+                               stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               stderr=subprocess.PIPE)
+
+    def _feed_stdin():
+        try:
+            for data in iter(lambda: channel.recv(SERVER_BUF_SIZE), b''):
+                process.stdin.write(data)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    def _send_stderr():
+        for data in iter(lambda: process.stderr.read(SERVER_BUF_SIZE), b''):
+            channel.sendall_stderr(data)
+
+    threads = [threading.Thread(target=_feed_stdin, daemon=True),
+               threading.Thread(target=_send_stderr, daemon=True)]
+    for thread in threads:
+        thread.start()
+    for data in iter(lambda: process.stdout.read(SERVER_BUF_SIZE), b''):
+        channel.sendall(data)
+    threads[1].join()
+    channel.send_exit_status(process.wait())
+    channel.shutdown_write()
+    channel.close()
+
+
+def serve():
+    '''
+    run the server on an ephemeral loopback port, printing the port number
+    once it's listening. Runs until stdin is closed.
+    '''
+    host_key = paramiko.RSAKey.generate(2048)
+    listener = socket.socket()
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(16)
+    print(listener.getsockname()[1], flush=True)
+
+    def _accept():
+        while True:
+            sock, _address = listener.accept()
+            transport = paramiko.Transport(sock)
+            transport.add_server_key(host_key)
+            transport.start_server(server=ExecOnlyServer())
+
+    threading.Thread(target=_accept, daemon=True).start()
+    sys.stdin.read()
+
+
+def start_server():
+    '''start the server subprocess, returns (process, port)'''
+    process = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                'serve'],
+                               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    port = int(process.stdout.readline())
+    return process, port
+
+
+def stop_server(process):
+    process.stdin.close()
+    process.wait()
+
+
+class CountingSocket:
+    '''a socket that counts the bytes going through it'''
+    def __init__(self, sock):
+        self._sock = sock
+        self.bytes_sent = self.bytes_received = 0
+
+    def send(self, data):
+        sent = self._sock.send(data)
+        self.bytes_sent += sent
+        return sent
+
+    def recv(self, size):
+        data = self._sock.recv(size)
+        self.bytes_received += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+def make_tree(root, files, seed=DEFAULT_SEED):
+    '''
+    generate a tree of small files under root, FILES_PER_DIR to a
+    directory and DIRS_PER_DIR directories to a directory. The same
+    arguments always make the same tree, which is only made once. The
+    ODD_NAMES files are added to it.
+    '''
+    os.makedirs(root, exist_ok=True)
+    for name in ODD_NAMES:
+        with open(os.path.join(root, name), 'wb') as tree_file:
+            tree_file.write(name.encode('utf-8'))
+    done_marker = root + '.done'
+    if os.path.exists(done_marker):
+        return
+    l.info("Generating %d files under %s", files, root)
+    rand = random.Random(seed)
+    for index in range(files):
+        dir_index = index // FILES_PER_DIR
+        parts = list()
+        while True:
+            parts.append('d{:02d}'.format(dir_index % DIRS_PER_DIR))
+            dir_index //= DIRS_PER_DIR
+            if dir_index == 0:
+                break
+        dir_name = os.path.join(root, *reversed(parts))
+        if index % FILES_PER_DIR == 0:
+            os.makedirs(dir_name, exist_ok=True)
+        size = rand.randrange(MAX_FILE_SIZE)
+        with open(os.path.join(dir_name, 'f{:04d}'.format(index)),
+                  'wb') as tree_file:
+            tree_file.write(rand.getrandbits(size * 8).to_bytes(size,
+                                                                'little'))
+    with open(done_marker, 'w'):
+        pass
+
+
+def bench_platform(work_dir, tree_root, settings):
+    '''a platform keeping its remote files in work_dir, scanning tree_root'''
+    remote_dir = os.path.join(work_dir, 'remote')
+    os.makedirs(remote_dir, exist_ok=True)
+    overrides = dict(
+        SCAN_ROOT=tree_root,
+        SUM_PROGRAM_REMOTE=os.path.join(remote_dir, 'file_sum'),
+        STAT_PROGRAM_REMOTE=os.path.join(remote_dir, 'file_stat'),
+        SUM_SPOOL_DIR=os.path.join(remote_dir, 'file_sums'),
+        MERKLE_SPOOL=os.path.join(remote_dir, 'file_sums.sorted'),
+        RESUMABLE_SPOOL=os.path.join(remote_dir, 'file_sums.resumable'),
+        AGENT_SPOOL=os.path.join(remote_dir, 'safestart-agent'),
+        LAYER_DIR=os.path.join(work_dir, 'baselines'))
+    platform = type('Benchmark', (platforms.Ubuntu_14_04,), overrides)
+    return platform.configure(settings)
+
+
+def _reset_peak_rss():
+    '''reset the kernel's peak RSS of this process, where it can be done'''
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def _peak_rss():
+    '''peak RSS of this process in bytes'''
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError):
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PhaseTimer:
+    '''collects the metrics of the phases, in order'''
+    def __init__(self, counting_socket, files):
+        self._socket = counting_socket
+        self._files = files
+        self.phases = OrderedDict()
+
+    def run(self, name, fun, *args):
+        _reset_peak_rss()
+        sent, received = self._socket.bytes_sent, self._socket.bytes_received
+        start_time = time()
+        result = fun(*args)
+        wall_time = time() - start_time
+        bytes_sent = self._socket.bytes_sent - sent
+        bytes_received = self._socket.bytes_received - received
+        self.phases[name] = metrics = dict(
+            wall_time=wall_time,
+            files_per_second=self._files / wall_time if wall_time else 0.0,
+            mb_per_second=(bytes_sent + bytes_received) / 1e6 / wall_time
+            if wall_time else 0.0,
+            peak_rss=_peak_rss(),
+            bytes_sent=bytes_sent,
+            bytes_received=bytes_received)
+        l.info("%-18s %8.2fs %10.0f files/s %8.2f MB/s %8.1f MB RSS "
+               "%12d sent %12d received", name, wall_time,
+               metrics['files_per_second'], metrics['mb_per_second'],
+               metrics['peak_rss'] / 1e6, bytes_sent, bytes_received)
+        return result
+
+
+def run_benchmark(work_dir, files, send_mb, seed, settings):
+    '''run all the phases, returns the PhaseTimer'''
+    work_dir = os.path.abspath(work_dir)
+    tree_root = os.path.join(work_dir, 'tree-{}-{}'.format(files, seed))
+    make_tree(tree_root, files, seed)
+    platform = bench_platform(work_dir, tree_root, settings)
+
+    send_path = os.path.join(work_dir, 'send-{}mb'.format(send_mb))
+    if not os.path.exists(send_path):
+        with open(send_path, 'wb') as send_file:
+            send_file.write(os.urandom(send_mb * 1024 * 1024))
+
+    db_host = os.path.join(work_dir, BENCH_HOST)
+    for name in os.listdir(work_dir):
+        if name.startswith(BENCH_HOST + '.tripwire.'):
+            os.remove(os.path.join(work_dir, name))
+    shutil.rmtree(platform.LAYER_DIR, ignore_errors=True)
+
+    server, port = start_server()
+    try:
+        sock = CountingSocket(socket.create_connection(('127.0.0.1', port)))
+        client = DBSSHClient()
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        timer = PhaseTimer(sock, files)
+        client_key = paramiko.RSAKey.generate(2048)
+        timer.run('connect', lambda: client.connect(
+            '127.0.0.1', port, username='root', pkey=client_key,
+            allow_agent=False, look_for_keys=False,
+            compress=platform.SSH_COMPRESSION, sock=sock))
+        try:
+            timer.run('send_file', client.send_file, send_path,
+                      os.path.join(work_dir, 'remote', 'received'))
+
+            twdb = TripwireDatabase(client, db_host, platform)
+            timer.run('get_remote_sums', twdb.get_remote_sums, True)
+            timer.run('update_database', twdb.update_database)
+
+            twdb = TripwireDatabase(client, db_host, platform)
+            with recording(BENCH_HOST) as recorder:
+                timer.run('get_remote_sums_2', twdb.get_remote_sums)
+                diff = timer.run('compare_databases', twdb.compare_databases)
+            if diff:
+                raise AssertionError("{} differences on an unchanged "
+                                     "tree".format(len(diff)))
+            rehashed = recorder.counters.get('files_hashed', 0)
+            if platform.INCREMENTAL and rehashed:
+                raise AssertionError("{} files hashed again in an unchanged "
+                                     "tree".format(rehashed))
+            check_deletion(client, db_host, platform,
+                           os.path.join(tree_root, DELETED_NAME))
+            check_host_key_save(work_dir, port, client_key, platform)
+        finally:
+            client.close()
+    finally:
+        stop_server(server)
+    return timer
+
+
+def check_deletion(client, db_host, platform, path):
+    '''
+    delete the file, update the database and compare it - untimed, this is
+    a check of the journal and the layered overlays rather than a phase. A
+    layered database records the deletion in its overlay, unless journaled.
+    '''
+    os.remove(path)
+    twdb = TripwireDatabase(client, db_host, platform)
+    twdb.get_remote_sums(True)
+    twdb.update_database()
+    if platform.DB_FORMAT == 'layered' and not platform.JOURNAL:
+        with open(OVERLAY_FILENAME_PATTERN.format(db_host), 'rb') as db_file:
+            if b'D\t' + os.fsencode(path) + b'\n' not in db_file.read():
+                raise AssertionError("The deletion of {!r} is not in the "
+                                     "overlay".format(path))
+    twdb = TripwireDatabase(client, db_host, platform)
+    twdb.get_remote_sums()
+    diff = twdb.compare_databases()
+    if diff:
+        raise AssertionError("{} differences after deleting {!r}: {!r}".format(
+            len(diff), path, diff[:8]))
+
+
+class _LoopbackPool(ConnectionPool):
+    '''a ConnectionPool whose connections go to the benchmark's server'''
+    def __init__(self, hosts_file, port, client_key):
+        super().__init__(hosts_file)
+        self._port = port
+        self._client_key = client_key
+
+    def _connect(self, host_config):
+        client = DBSSHClient()
+        client.use_host_keys(self._host_keys)
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        client.connect(host_config.host, self._port,
+                       username=host_config.username, pkey=self._client_key,
+                       allow_agent=False, look_for_keys=False)
+        return client
+
+
+def check_host_key_save(work_dir, port, client_key, platform):
+    '''
+    connect through a pool with an empty known hosts file - the one new key
+    must be saved from within the host's recording, not when the pool closes
+    '''
+    hosts_file = os.path.join(work_dir, 'known_hosts')
+    if os.path.exists(hosts_file):
+        os.remove(hosts_file)
+    open(hosts_file, 'w').close()
+    host_config = HostConfig('127.0.0.1', 'root', None, platform, None)
+    with _LoopbackPool(hosts_file, port, client_key) as pool:
+        with recording(BENCH_HOST) as recorder:
+            pool.get(host_config)
+        if 'host_key_save' not in recorder.phases:
+            raise AssertionError("A new host key was not saved as part of "
+                                 "the host's run")
+        if not os.path.getsize(hosts_file):
+            raise AssertionError("The new host key is not in " + hosts_file)
+
+
+def _parse_lines(db_file):
+    '''parse a listing or a text database a line at a time, for reference'''
+    entries = list()
+    for line in db_file:
+        if line.startswith(b'#'):
+            continue
+        fields = line.rstrip(b'\n').split(None, 5)
+        if len(fields) == 2:
+            file_sum, file_name = fields
+            entries.append((file_name, file_sum, None))
+        else:
+            file_sum, size, mtime, ctime, inode, file_name = fields
+            entries.append((file_name, file_sum, (size, mtime, ctime, inode)))
+    return entries
+
+
+def _parse_chunks(db_file):
+    '''parse a listing or a text database a chunk at a time'''
+    entries = list()
+    for chunk in iter_chunks(db_file):
+        entries.extend(parse_chunk(chunk))
+    return entries
+
+
+def _make_listings(work_dir, lines):
+    '''
+    write a sums listing and a text database of lines entries to work_dir,
+    once, returns their filenames
+    '''
+    sums_path = os.path.join(work_dir, 'parse-{}.sums'.format(lines))
+    db_path = os.path.join(work_dir, 'parse-{}.db'.format(lines))
+    if not os.path.exists(db_path):
+        l.info("Writing %d line listings to %s", lines, work_dir)
+        with open(sums_path + '.tmp', 'wb') as sums_file, \
+                open(db_path + '.tmp', 'wb') as db_file:
+            db_file.write(b'# algorithm: sha256\n')
+            for index in range(lines):
+                file_sum = hashlib.sha256(str(index).encode()).hexdigest()
+                file_name = '/usr/lib/d{:05d}/f{:07d}'.format(
+                    index // FILES_PER_DIR, index)
+                sums_file.write('{}  {}\n'.format(
+                    file_sum, file_name).encode())
+                db_file.write('{}\t{}\t1792193750\t1792193751\t{}\t{}\n'
+                              .format(file_sum, index % MAX_FILE_SIZE,
+                                      13576553 + index, file_name).encode())
+        os.replace(sums_path + '.tmp', sums_path)
+        os.replace(db_path + '.tmp', db_path)
+    return sums_path, db_path
+
+
+def bench_parsers(work_dir, lines):
+    '''log the times of both parsers on both listings, and the speedups'''
+    for path in _make_listings(work_dir, lines):
+        times = dict()
+        for parser in (_parse_lines, _parse_chunks):
+            best = None
+            for _run in range(PARSE_RUNS):
+                with open(path, 'rb') as db_file:
+                    start_time = time()
+                    entries = parser(db_file)
+                    wall_time = time() - start_time
+                if len(entries) != lines:
+                    raise AssertionError("{} parsed {} of the {} lines".format(
+                        parser.__name__, len(entries), lines))
+                del entries
+                best = wall_time if best is None else min(best, wall_time)
+            times[parser] = best
+        l.info("%s: a line at a time %.2fs, a chunk at a time %.2fs "
+               "(%.0f lines/s), %.1fx", os.path.basename(path),
+               times[_parse_lines], times[_parse_chunks],
+               lines / times[_parse_chunks],
+               times[_parse_lines] / times[_parse_chunks])
+
+
+def find_regressions(phases, baseline, tolerance):
+    '''returns (phase, metric, value, baseline value) of the regressions'''
+    regressions = list()
+    for phase, metrics in phases.items():
+        for metric in REGRESSION_METRICS:
+            base_value = baseline.get(phase, dict()).get(metric)
+            if base_value and metrics[metric] > base_value * (1 + tolerance):
+                regressions.append((phase, metric, metrics[metric],
+                                    base_value))
+    return regressions
+
+
+def main(args):
+    files = int(args.get('files') or DEFAULT_FILES)
+    send_mb = int(args.get('send_mb') or DEFAULT_SEND_MB)
+    seed = int(args.get('seed') or DEFAULT_SEED)
+    work_dir = args.get('work') or DEFAULT_WORK_DIR
+    baseline_file = args.get('baseline') or DEFAULT_BASELINE
+    tolerance = float(args.get('tolerance') or DEFAULT_TOLERANCE)
+    settings = dict((key, value) for key, value in args.items()
+                    if key not in BENCH_ARGS)
+    scenario = ' '.join(['files={}'.format(files),
+                         'send_mb={}'.format(send_mb)] +
+                        ['{}={}'.format(key, value)
+                         for key, value in sorted(settings.items())])
+
+    os.makedirs(work_dir, exist_ok=True)
+    timer = run_benchmark(work_dir, files, send_mb, seed, settings)
+
+    baselines = dict()
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as json_file:
+            baselines = json.load(json_file)
+
+    exit_code = 0
+    if 'save' in args:
+        baselines[scenario] = timer.phases
+        with open(baseline_file, 'w') as json_file:
+            json.dump(baselines, json_file, indent=2, sort_keys=True)
+        l.info("Saved the baseline for '%s' to %s", scenario, baseline_file)
+    elif scenario in baselines:
+        regressions = find_regressions(timer.phases, baselines[scenario],
+                                       tolerance)
+        for phase, metric, value, base_value in regressions:
+            l.error("Regression in %s: %s is %.6g, baseline %.6g",
+                    phase, metric, value, base_value)
+        if regressions:
+            exit_code = 1
+        else:
+            l.info("No regressions against the baseline for '%s'", scenario)
+    else:
+        l.info("No baseline for '%s' in %s", scenario, baseline_file)
+    return exit_code
+
+
+if __name__ == '__main__':
+    args = parse_arguments(sys.argv[1:])
+    if 'serve' in args:
+        serve()
+    elif 'parse' in args:
+        work_dir = args.get('work') or DEFAULT_WORK_DIR
+        os.makedirs(work_dir, exist_ok=True)
+        bench_parsers(work_dir, int(args['parse'] or DEFAULT_PARSE_LINES))
+    else:
+        sys.exit(main(args))
@@ -0,0 +1,370 @@
+'''
+A compact, binary, memory mapped format for the tripwire database.
+
+The file is laid out as:
+
+    header      - see HEADER below
+    digests     - count fixed width raw digests, sorted by file name
+    metadata    - count (size, mtime, ctime, inode) signed 64 bit tuples,
+                  only when FLAG_METADATA is set. -1 everywhere = no metadata
+    offsets     - count + 1 unsigned 64 bit offsets into the names
+    names       - the file names, back to back
+
+All numbers are little endian. The file is opened with mmap, so looking a
+name up is a binary search that only touches the pages it needs, and
+nothing is parsed up front.
+
+Usage:
+
+with open('host.tripwire.bdb', 'wb') as db_file:
+    write_database(db_file, entries)
+
+with BinaryDatabase('host.tripwire.bdb') as db:
+    file_sum, meta = db.get(b'/etc/passwd')
+    for file_name, file_sum, meta in db:
+        ...
+
+PackedEntries is the same layout in memory, for a database that has to be
+held in memory whatever its format:
+
+entries = PackedEntries(sorted_entries)
+
+LayeredEntries is the view of any of them with an overlay of changes, only
+the overlay in memory:
+
+entries = LayeredEntries(BinaryDatabase(layer_filename), overlay)
+'''
+
+from array import array
+from binascii import hexlify, unhexlify
+from bisect import bisect_left, bisect_right
+from itertools import accumulate, chain, islice
+import mmap
+from operator import itemgetter
+from shutil import copyfileobj
+from struct import Struct
+from tempfile import TemporaryFile
+
+import log
+l = log.getLogger(__name__)
+
+
+MAGIC = b'SSTWDB\r\n'
+VERSION = 1
+FLAG_METADATA = 1
+DEFAULT_ALGORITHM = 'sha256'
+DEFAULT_DIGEST_SIZE = 32
+
+# magic, version, flags, count, digest size, algorithm, then the offsets of
+# the digests, metadata, offsets and names sections
+HEADER = Struct('<8sIIQI16sQQQQ')
+META = Struct('<qqqq')
+OFFSET = Struct('<Q')
+NO_META = (-1, -1, -1, -1)
+
+
+class DatabaseFormatError(ValueError):
+    '''the file is not a binary tripwire database we can read'''
+
+
+def is_binary_database(filename):
+    '''True if the file starts with the binary database magic'''
+    try:
+        with open(filename, 'rb') as db_file:
+            return db_file.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+def write_database(db_file, entries, algorithm=DEFAULT_ALGORITHM):
+    '''
+    write the (file_name, file_sum, metadata) tuples, sorted by name, to the
+    open binary file. file_sum is a hex digest as bytes, metadata a tuple of
+    decimal numbers as bytes, or None. The sections are spooled to temporary
+    files, so memory use doesn't depend on the number of entries.
+    '''
+    digest_size = None
+    count = 0
+    has_meta = False
+    name_offset = 0
+    with TemporaryFile() as digests, TemporaryFile() as metas, \
+            TemporaryFile() as offsets, TemporaryFile() as names:
+        for name, file_sum, meta in entries:
+            digest = unhexlify(file_sum)
+            if digest_size is None:
+                digest_size = len(digest)
+            elif len(digest) != digest_size:
+                raise ValueError(
+                    "Digest of {!r} is {} bytes, expected {}".format(
+                        name, len(digest), digest_size))
+            digests.write(digest)
+            if meta is None:
+                metas.write(META.pack(*NO_META))
+            else:
+                has_meta = True
+                metas.write(META.pack(*[int(value) for value in meta]))
+            offsets.write(OFFSET.pack(name_offset))
+            names.write(name)
+            name_offset += len(name)
+            count += 1
+        offsets.write(OFFSET.pack(name_offset))
+
+        if digest_size is None:
+            digest_size = DEFAULT_DIGEST_SIZE
+        digests_at = HEADER.size
+        meta_at = digests_at + count * digest_size
+        offsets_at = meta_at + (count * META.size if has_meta else 0)
+        names_at = offsets_at + (count + 1) * OFFSET.size
+
+        db_file.write(HEADER.pack(MAGIC, VERSION,
+                                  FLAG_METADATA if has_meta else 0,
+                                  count, digest_size,
+                                  algorithm.encode('ascii'),
+                                  digests_at, meta_at, offsets_at, names_at))
+        sections = (digests, metas, offsets, names) if has_meta else \
+            (digests, offsets, names)
+        for section in sections:
+            section.seek(0)
+            copyfileobj(section, db_file)
+
+    l.debug("Wrote %d entries to a binary database", count)
+    return count
+
+
+class _IndexedEntries:
+    '''
+    lookups and iteration over sorted entries that have name(index),
+    digest(index) and metadata(index)
+    '''
+    def entry(self, index):
+        '''the (file_name, file_sum, metadata) tuple at the index'''
+        return (self.name(index), hexlify(self.digest(index)),
+                self.metadata(index))
+
+    def lower_bound(self, name):
+        '''binary search for the index of the first name >= name'''
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self.name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, name):
+        '''binary search for the index of the name, -1 if it's not there'''
+        index = self.lower_bound(name)
+        if index < len(self) and self.name(index) == name:
+            return index
+        return -1
+
+    def get(self, name, default=None):
+        '''returns (file_sum, metadata) for the name, or default'''
+        index = self.find(name)
+        if index < 0:
+            return default
+        return hexlify(self.digest(index)), self.metadata(index)
+
+    def __contains__(self, name):
+        return self.find(name) >= 0
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self.entry(index)
+
+
+class PackedEntries(_IndexedEntries):
+    '''
+    (file_name, file_sum) entries packed into three flat buffers - the names
+    back to back, their offsets and the raw digests - instead of a bytes
+    object per name and per sum and a dict entry per file. The metadata is
+    not kept. entries must be sorted by name.
+    '''
+    def __init__(self, entries=()):
+        self._names = bytearray()
+        self._offsets = array('Q', [0])
+        self._digests = bytearray()
+        self._digest_size = None
+        for name, file_sum, _meta in entries:
+            self.append(name, file_sum)
+
+    def append(self, name, file_sum):
+        '''add an entry after the last one'''
+        digest = unhexlify(file_sum)
+        if self._digest_size is None:
+            self._digest_size = len(digest)
+        elif len(digest) != self._digest_size:
+            raise ValueError("Digest of {!r} is {} bytes, expected {}".format(
+                name, len(digest), self._digest_size))
+        self._names += name
+        self._offsets.append(len(self._names))
+        self._digests += digest
+
+    def extend(self, entries):
+        '''
+        add a list of entries after the last one, in bulk rather than an
+        append() each
+        '''
+        if not entries:
+            return
+        names = list(map(itemgetter(0), entries))
+        file_sums = list(map(itemgetter(1), entries))
+        if self._digest_size is None:
+            self._digest_size = len(file_sums[0]) // 2
+        if set(map(len, file_sums)) != {self._digest_size * 2}:
+            raise ValueError("Digests are not all {} bytes".format(
+                self._digest_size))
+        self._offsets.extend(islice(accumulate(chain(
+            (self._offsets[-1],), map(len, names))), 1, None))
+        self._names += b''.join(names)
+        self._digests += unhexlify(b''.join(file_sums))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def name(self, index):
+        '''the file name at the index'''
+        return bytes(self._names[self._offsets[index]:
+                                 self._offsets[index + 1]])
+
+    def digest(self, index):
+        '''the raw digest at the index'''
+        at = index * self._digest_size
+        return bytes(self._digests[at:at + self._digest_size])
+
+    def metadata(self, index):
+        return None
+
+
+class BinaryDatabase(_IndexedEntries):
+    '''
+    read only access to a binary tripwire database through mmap. Entries are
+    (file_name, file_sum, metadata) tuples just like the text database, with
+    file_sum as a hex digest.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as db_file:
+            self._map = mmap.mmap(db_file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        try:
+            self._read_header()
+        except Exception:
+            self._map.close()
+            raise
+
+    def _read_header(self):
+        if len(self._map) < HEADER.size:
+            raise DatabaseFormatError("{} is too short".format(self.filename))
+        (magic, version, flags, self._count, self._digest_size,
+         algorithm, self._digests_at, self._meta_at, self._offsets_at,
+         self._names_at) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise DatabaseFormatError(
+                "{} is not a binary tripwire database".format(self.filename))
+        if version != VERSION:
+            raise DatabaseFormatError("{} is version {}, expected {}".format(
+                self.filename, version, VERSION))
+        self.has_metadata = bool(flags & FLAG_METADATA)
+        self.algorithm = algorithm.rstrip(b'\0').decode('ascii')
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def name(self, index):
+        '''the file name at the index'''
+        start, end = self._name_bounds(index)
+        return self._map[start:end]
+
+    def _name_bounds(self, index):
+        at = self._offsets_at + index * OFFSET.size
+        start, = OFFSET.unpack_from(self._map, at)
+        end, = OFFSET.unpack_from(self._map, at + OFFSET.size)
+        return self._names_at + start, self._names_at + end
+
+    def digest(self, index):
+        '''the raw digest at the index'''
+        at = self._digests_at + index * self._digest_size
+        return self._map[at:at + self._digest_size]
+
+    def metadata(self, index):
+        '''the (size, mtime, ctime, inode) at the index, or None'''
+        if not self.has_metadata:
+            return None
+        meta = META.unpack_from(self._map, self._meta_at + index * META.size)
+        if meta == NO_META:
+            return None
+        return tuple(b'%d' % value for value in meta)
+
+
+class LayeredEntries(_IndexedEntries):
+    '''
+    the entries of base (any of the above) with an overlay of changes, a
+    mapping of file_name --> (file_name, file_sum, metadata) tuple, or None
+    for a deleted file. Only the overlay is held in memory, and an index is
+    mapped to the overlay or to the base with two binary searches.
+    '''
+    def __init__(self, base, overlay):
+        self._base = base
+        # the overlay's entries in order, and their index in the view
+        self._entries = list()
+        self._at = array('Q')
+        # the indexes of the base entries the overlay replaces or deletes
+        self._hidden = array('Q')
+        for name in sorted(overlay):
+            index = base.lower_bound(name)
+            if overlay[name] is not None:
+                self._at.append(index - len(self._hidden) + len(self._entries))
+                self._entries.append(overlay[name])
+            if index < len(base) and base.name(index) == name:
+                self._hidden.append(index)
+        self._length = len(base) - len(self._hidden) + len(self._entries)
+
+    def __len__(self):
+        return self._length
+
+    def _locate(self, index):
+        '''the overlay entry at the index, or None and the base's index'''
+        before = bisect_left(self._at, index)
+        if before < len(self._at) and self._at[before] == index:
+            return self._entries[before], None
+        # the base index with as many visible entries before it as the
+        # index has base entries before it
+        visible = index - before
+        base_index = visible
+        while True:
+            moved = visible + bisect_right(self._hidden, base_index)
+            if moved == base_index:
+                return None, base_index
+            base_index = moved
+
+    def name(self, index):
+        '''the file name at the index'''
+        entry, base_index = self._locate(index)
+        if entry is None:
+            return self._base.name(base_index)
+        return entry[0]
+
+    def digest(self, index):
+        '''the raw digest at the index'''
+        entry, base_index = self._locate(index)
+        if entry is None:
+            return self._base.digest(base_index)
+        return unhexlify(entry[1])
+
+    def metadata(self, index):
+        '''the (size, mtime, ctime, inode) at the index, or None'''
+        entry, base_index = self._locate(index)
+        if entry is None:
+            return self._base.metadata(base_index)
+        return entry[2]
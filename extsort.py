@@ -0,0 +1,75 @@
+'''
+External merge sort with a memory ceiling.
+
+Entries are collected until they take about max_bytes, sorted and spilled
+to a temporary file as a run. Once the input is exhausted the runs are
+merged, reading every run back a batch at a time - so the memory used
+depends on max_bytes and the number of runs, not on the number of entries.
+
+Usage:
+
+for entry in external_sort(entries, 64 * 1024 * 1024):
+    ...
+'''
+
+import heapq
+from operator import itemgetter
+import pickle
+from tempfile import TemporaryFile
+
+import log
+l = log.getLogger(__name__)
+
+
+# entries are written to and read back from the runs this many at a time
+RUN_BATCH = 4096
+# a rough size of an entry tuple in memory, on top of its first field
+ENTRY_OVERHEAD = 200
+
+
+def _write_run(entries):
+    '''spill the sorted entries to a temporary file'''
+    run = TemporaryFile()
+    for start in range(0, len(entries), RUN_BATCH):
+        pickle.dump(entries[start:start + RUN_BATCH], run,
+                    pickle.HIGHEST_PROTOCOL)
+    run.seek(0)
+    return run
+
+
+def _read_run(run):
+    '''the entries of a run, a batch at a time'''
+    while True:
+        try:
+            batch = pickle.load(run)
+        except EOFError:
+            return
+        yield from batch
+
+
+def external_sort(entries, max_bytes, key=itemgetter(0)):
+    '''
+    yield the entries (tuples starting with a bytes name, by default) sorted
+    by key, keeping roughly max_bytes of them in memory at most
+    '''
+    runs = list()
+    try:
+        buffer, size = list(), 0
+        for entry in entries:
+            buffer.append(entry)
+            size += ENTRY_OVERHEAD + len(entry[0])
+            if size >= max_bytes:
+                buffer.sort(key=key)
+                runs.append(_write_run(buffer))
+                buffer, size = list(), 0
+        buffer.sort(key=key)
+
+        if not runs:
+            yield from buffer
+            return
+        l.debug("Merging %d sorted runs", len(runs) + 1)
+        yield from heapq.merge(*[_read_run(run) for run in runs] +
+                               [iter(buffer)], key=key)
+    finally:
+        for run in runs:
+            run.close()
@@ -0,0 +1,125 @@
+'''
+Run a per-host job over the whole fleet with a bounded pool of workers.
+
+Every host is isolated from the others - an exception or a failed check on
+one host is recorded in its result and the rest of the fleet carries on.
+
+Usage:
+
+def job(host_config):
+    ...
+    return UNLOCKED, "all good"
+
+results = run_fleet(hosts_config, job, concurrency=8)
+log_summary(results)
+
+'''
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import current_thread
+from time import time
+
+import log
+import metrics
+l = log.getLogger(__name__)
+
+
+UNLOCKED = 'unlocked'
+UPDATED = 'updated'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+STATUSES = (UNLOCKED, UPDATED, FAILED, SKIPPED)
+
+# raised - the job failed on an exception rather than returning a status
+HostResult = namedtuple(typename='HostResult',
+                        field_names=['host', 'status', 'elapsed', 'message',
+                                     'metrics', 'raised'],
+                        defaults=(False,))
+
+
+def _run_one(host_job, host_config):
+    '''
+    run the job for a single host, never letting an exception escape, and
+    recording its metrics
+    '''
+    # name the worker after the host, so the log lines can be told apart
+    current_thread().name = host_config.host
+    start_time = time()
+    raised = False
+    with metrics.recording(host_config.host) as recorder:
+        try:
+            status, message = host_job(host_config)
+        except Exception as exc:
+            l.exception("Host %s failed", host_config.host)
+            status, message = FAILED, "{}: {}".format(type(exc).__name__,
+                                                      exc)
+            raised = True
+    return HostResult(host_config.host, status, time() - start_time, message,
+                      recorder.as_dict(), raised)
+
+
+def run_fleet(hosts_config, host_job, concurrency=1):
+    '''
+    run host_job(host_config) for every host, at most concurrency at a time.
+
+    host_job returns a (status, message) tuple. Returns a list of HostResult
+    in the order of hosts_config. Hosts that never got to run (e.g. after
+    a keyboard interrupt) are reported as skipped.
+    '''
+    concurrency = max(1, min(concurrency, len(hosts_config) or 1))
+    l.info("Running %d hosts, %d at a time", len(hosts_config), concurrency)
+
+    results = list()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [(host_config,
+                    executor.submit(_run_one, host_job, host_config))
+                   for host_config in hosts_config]
+        try:
+            for host_config, future in futures:
+                results.append(future.result())
+        except KeyboardInterrupt:
+            l.error("Interrupted, waiting for running hosts to finish")
+            for host_config, future in futures[len(results):]:
+                if future.cancel():
+                    results.append(HostResult(host_config.host, SKIPPED,
+                                              0.0, "interrupted", None))
+                else:
+                    results.append(future.result())
+
+    return results
+
+
+def log_summary(results):
+    '''log a per-host table of the results and the totals per status'''
+    counts = dict((status, 0) for status in STATUSES)
+    for result in results:
+        counts[result.status] += 1
+
+    l.info("Fleet summary: %s",
+           ", ".join("{} {}".format(counts[status], status)
+                     for status in STATUSES))
+    width = max([len(result.host) for result in results] + [4])
+    for result in results:
+        log_fun = l.error if result.status == FAILED else l.info
+        log_fun("%-*s %-8s %8.1fs %s", width, result.host, result.status,
+                result.elapsed, result.message)
+
+
+def reports(results):
+    '''
+    the per-host metrics of the results, along with their status and
+    message, for metrics.write_json_report()
+    '''
+    host_reports = list()
+    for result in results:
+        report = dict(result.metrics or dict(host=result.host,
+                                             elapsed=result.elapsed))
+        report.update(status=result.status, message=result.message)
+        host_reports.append(report)
+    return host_reports
+
+
+def all_succeeded(results):
+    '''True if no host failed or got skipped'''
+    return all(result.status in (UNLOCKED, UPDATED) for result in results)
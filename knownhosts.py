@@ -0,0 +1,147 @@
+'''
+The known hosts of a run, shared by all of its connections.
+
+The known hosts file is read once, into an index of the host names it
+lists, rather than once per connection - and every lookup is a dict lookup
+instead of a scan of all the entries. Hashed host names (|1|salt|hash) can
+only be matched by hashing the name looked up with their salt, so a lookup
+costs one HMAC per distinct salt in the file, once per host name.
+
+New keys are kept in memory and written out by flush(), atomically, along
+with the rest of the file. Call it from the thread that added them, so the
+save is timed as part of that host's run.
+
+Usage:
+
+store = HostKeyStore('known_hosts.db')
+client.use_host_keys(store)     # see sshstuff.DBSSHClient
+...
+store.flush()
+'''
+
+import os
+from threading import Lock
+
+from paramiko import HostKeys
+from paramiko.hostkeys import HostKeyEntry
+from paramiko.ssh_exception import SSHException
+
+import log
+import metrics
+l = log.getLogger(__name__)
+
+
+HASHED_PREFIX = '|1|'
+
+
+class _HostKeysOf(dict):
+    '''keytype --> key, with a list of keys() like paramiko's own lookups'''
+    def keys(self):
+        return list(super().keys())
+
+
+class HostKeyStore(HostKeys):
+    '''
+    an indexed paramiko HostKeys, safe to share between threads. lookup()
+    returns a snapshot of the host's keys, changing it changes nothing.
+    '''
+    def __init__(self, filename):
+        self._filename = filename
+        self._lock = Lock()
+        # host name as in the file --> its entries
+        self._names = dict()
+        # the salts of the hashed host names
+        self._salts = set()
+        # host name looked up --> the names in the file it matches
+        self._aliases = dict()
+        self._pending = 0
+        super().__init__()
+        if os.path.exists(filename):
+            self.load(filename)
+            l.debug("Read %d host keys from %s", len(self._entries),
+                    filename)
+
+    def _index(self, entry):
+        for name in entry.hostnames:
+            self._names.setdefault(name, list()).append(entry)
+            if name.startswith(HASHED_PREFIX):
+                salt = name.split('|')[2]
+                if salt not in self._salts:
+                    self._salts.add(salt)
+                    self._aliases.clear()
+
+    def _matching_names(self, hostname):
+        '''the names in the file that are, or hash to, the host name'''
+        names = self._aliases.get(hostname)
+        if names is None:
+            names = [hostname] + [self.hash_host(hostname, salt)
+                                  for salt in self._salts]
+            self._aliases[hostname] = names
+        return names
+
+    def _has_key(self, name, key):
+        return any(entry.key is not None and
+                   entry.key.get_name() == key.get_name() and
+                   entry.key.asbytes() == key.asbytes()
+                   for entry in self._names.get(name, ()))
+
+    def load(self, filename):
+        '''merge the keys in the file, dropping the ones already known'''
+        with self._lock, open(filename, 'r') as hosts_file:
+            for lineno, line in enumerate(hosts_file, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    entry = HostKeyEntry.from_line(line, lineno)
+                except SSHException:
+                    continue
+                if entry is None:
+                    continue
+                entry.hostnames = [name for name in entry.hostnames
+                                   if not self._has_key(name, entry.key)]
+                if entry.hostnames:
+                    self._entries.append(entry)
+                    self._index(entry)
+
+    def lookup(self, hostname):
+        with self._lock:
+            keys = _HostKeysOf()
+            for name in self._matching_names(hostname):
+                for entry in self._names.get(name, ()):
+                    if entry.key is not None:
+                        keys.setdefault(entry.key.get_name(), entry.key)
+        return keys or None
+
+    def add(self, hostname, keytype, key):
+        with self._lock:
+            for entry in self._names.get(hostname, ()):
+                if entry.key is not None and entry.key.get_name() == keytype:
+                    entry.key = key
+                    break
+            else:
+                entry = HostKeyEntry([hostname], key)
+                self._entries.append(entry)
+                self._index(entry)
+            self._pending += 1
+        l.info("New %s host key for %s", keytype, hostname)
+
+    def clear(self):
+        with self._lock:
+            super().clear()
+            self._names.clear()
+            self._salts.clear()
+            self._aliases.clear()
+
+    def flush(self):
+        '''write all the keys to the file if any were added, atomically'''
+        with self._lock:
+            if not self._pending:
+                return
+            with metrics.phase('host_key_save'):
+                temp_filename = self._filename + '.tmp'
+                self.save(temp_filename)
+                os.replace(temp_filename, self._filename)
+            l.debug("Wrote %d new host keys to %s", self._pending,
+                    self._filename)
+            self._pending = 0
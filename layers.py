@@ -0,0 +1,88 @@
+'''
+A content addressed store of baseline layers, shared by the hosts.
+
+A layer is a binary database (see binarydb) named by the sha256 of its
+contents, so the hosts built from the same image share one copy of it on
+disk - and, being memory mapped, in memory. A host's layered database (see
+tripwire) only holds its changes from one of the layers.
+
+Usage:
+
+store = LayerStore('baselines')
+spool_filename = store.spool_filename('host')
+... write a binary database to spool_filename ...
+layer_filename = store.add(spool_filename)
+for layer_filename in store.layers('sha256'):
+    ...
+'''
+
+import hashlib
+import os
+
+from binarydb import BinaryDatabase, DatabaseFormatError
+import log
+l = log.getLogger(__name__)
+
+
+LAYER_SUFFIX = '.bdb'
+SPOOL_PATTERN = '.{}.spool'
+HOST_DIGITS = 16
+HASH_CHUNK = 1024 * 1024
+
+
+class LayerStore:
+    '''the layers in a directory, created if it's not there'''
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def spool_filename(self, host):
+        '''
+        where to write the host's database before it's added - named by a
+        digest of the host, which can be anything, even a path
+        '''
+        return os.path.join(self.directory, SPOOL_PATTERN.format(
+            hashlib.sha256(host.encode('utf-8')).hexdigest()[:HOST_DIGITS]))
+
+    def add(self, filename):
+        '''
+        move the binary database file into the store, returns the filename
+        of its layer - the existing one if there's an identical layer
+        '''
+        digest = hashlib.sha256()
+        with open(filename, 'rb') as db_file:
+            for chunk in iter(lambda: db_file.read(HASH_CHUNK), b''):
+                digest.update(chunk)
+        layer_filename = os.path.join(self.directory,
+                                      digest.hexdigest() + LAYER_SUFFIX)
+        if os.path.exists(layer_filename):
+            l.debug("Reusing the identical layer %s", layer_filename)
+            os.remove(filename)
+            self.touch(layer_filename)
+        else:
+            os.replace(filename, layer_filename)
+            l.info("Added the layer %s", layer_filename)
+        return layer_filename
+
+    def touch(self, layer_filename):
+        '''mark the layer as just used, see layers()'''
+        os.utime(layer_filename)
+
+    def layers(self, algorithm):
+        '''
+        the filenames of the layers hashed with the algorithm, the most
+        recently used first
+        '''
+        filenames = [os.path.join(self.directory, name)
+                     for name in os.listdir(self.directory)
+                     if name.endswith(LAYER_SUFFIX)]
+        filenames.sort(key=os.path.getmtime, reverse=True)
+        layers = list()
+        for filename in filenames:
+            try:
+                with BinaryDatabase(filename) as db:
+                    if db.algorithm == algorithm:
+                        layers.append(filename)
+            except DatabaseFormatError:
+                l.warning("Skipping %s, not a layer", filename)
+        return layers
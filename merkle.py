@@ -0,0 +1,144 @@
+'''
+Directory digests over a sorted tripwire database.
+
+The digest of a directory is the hash of the sha256sum style lines
+
+{file_sum}{space}{space}{file_name}{EOL}
+
+of every file under it, in name order - exactly what the remote end gets by
+piping the matching lines of its sorted sums through the sum program. Since
+the names are sorted, every directory is a contiguous range of entries, and
+a mismatching directory can be narrowed down to its mismatching children
+without looking at the rest of the tree.
+
+Usage:
+
+tree = MerkleTree(entries, 'host.tripwire.merkle', cache_key)
+if tree.digest(b'/') != remote_root_digest:
+    files, dirs = tree.children(b'/')
+    ...
+tree.save()
+'''
+
+import hashlib
+import os
+
+import log
+l = log.getLogger(__name__)
+
+
+ROOT = b'/'
+# the smallest byte that sorts after '/' - every name under the directory
+# 'a/' sorts before 'a0'
+AFTER_SLASH = b'0'
+HASH_CHUNK = 1024
+
+
+def _line(name, file_sum):
+    '''
+    the sha256sum style line the directory digests are made of, marked with
+    a leading backslash when the (escaped) name has one, like the program's
+    '''
+    mark = b'\\' if b'\\' in name else b''
+    return mark + file_sum + b'  ' + name + b'\n'
+
+
+class MerkleTree:
+    '''
+    lazily computed, cached directory digests over sorted entries. entries
+    needs len(), name(index) and entry(index), see binarydb.
+    Directory names always end with a '/'.
+    '''
+    def __init__(self, entries, cache_filename=None, cache_key=None,
+                 algorithm='sha256'):
+        self._entries = entries
+        self._algorithm = algorithm
+        self._cache_filename = cache_filename
+        self._cache_key = cache_key
+        self._digests = dict()
+        self._dirty = False
+        self._load_cache()
+
+    def _load_cache(self):
+        '''read the digests cached for the same database'''
+        if self._cache_filename is None or \
+                not os.path.exists(self._cache_filename):
+            return
+        with open(self._cache_filename, 'rb') as cache_file:
+            if cache_file.readline().rstrip(b'\n') != self._cache_key:
+                l.debug("Stale directory digests in %s", self._cache_filename)
+                return
+            for line in cache_file:
+                digest, prefix = line.rstrip(b'\n').split(b'  ', 1)
+                self._digests[prefix] = digest
+        l.debug("Read %d directory digests", len(self._digests))
+
+    def save(self):
+        '''write the digests computed so far to the cache file'''
+        if self._cache_filename is None or not self._dirty:
+            return
+        temp_filename = self._cache_filename + '.tmp'
+        with open(temp_filename, 'wb') as cache_file:
+            cache_file.write(self._cache_key + b'\n')
+            for prefix, digest in sorted(self._digests.items()):
+                cache_file.write(digest + b'  ' + prefix + b'\n')
+        os.replace(temp_filename, self._cache_filename)
+        self._dirty = False
+
+    def _bisect(self, name):
+        '''index of the first entry whose name is not less than name'''
+        low, high = 0, len(self._entries)
+        while low < high:
+            middle = (low + high) // 2
+            if self._entries.name(middle) < name:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _range(self, prefix):
+        '''the (start, end) indices of the entries under the directory'''
+        return (self._bisect(prefix),
+                self._bisect(prefix[:-1] + AFTER_SLASH))
+
+    def digest(self, prefix):
+        '''the hex digest of the directory'''
+        digest = self._digests.get(prefix)
+        if digest is None:
+            start, end = self._range(prefix)
+            hasher = hashlib.new(self._algorithm)
+            for chunk_start in range(start, end, HASH_CHUNK):
+                chunk_end = min(chunk_start + HASH_CHUNK, end)
+                hasher.update(b''.join(
+                    _line(*self._entries.entry(index)[:2])
+                    for index in range(chunk_start, chunk_end)))
+            digest = hasher.hexdigest().encode('ascii')
+            self._digests[prefix] = digest
+            self._dirty = True
+        return digest
+
+    def children(self, prefix):
+        '''
+        returns the (file_name, file_sum) tuples of the files directly in the
+        directory, and the names of its subdirectories
+        '''
+        files, dirs = list(), list()
+        index, end = self._range(prefix)
+        while index < end:
+            name, file_sum = self._entries.entry(index)[:2]
+            slash = name.find(b'/', len(prefix))
+            if slash < 0:
+                files.append((name, file_sum))
+                index += 1
+            else:
+                child = name[:slash + 1]
+                dirs.append(child)
+                # skip the rest of the child in one go
+                index = self._bisect(child[:-1] + AFTER_SLASH)
+        return files, dirs
+
+    def entries_under(self, prefix):
+        '''the (file_name, file_sum) tuples of all the files under prefix'''
+        start, end = self._range(prefix)
+        for index in range(start, end):
+            yield self._entries.entry(index)[:2]
@@ -0,0 +1,228 @@
+'''
+Per-host, per-phase performance metrics.
+
+Every host's work is recorded by its own PhaseRecorder, which is current in
+the host's worker thread. Phases nest, and a phase only gets the time spent
+in it and not in the phases nested inside it - so in the streaming pipeline,
+where the compare pulls parsed lines, which pull decompressed data, which
+waits on the channel, every stage gets its own share of the wall time.
+Outside of a recording everything here is a no-op.
+
+The phases are:
+
+connect, host_key_save, upload, compression_probe - setting up; a host
+                whose connection added a key to the known hosts file is
+                timed writing it back, see sshpool
+remote_wait   - waiting for the remote end, i.e. for the remote hashing
+transfer      - moving data through the channel
+decompress, parse, filter - the stages of reading the remote listings
+compare, db_write, sort - the consumers of the remote sums
+local_hash    - hashing a local copy of a host's filesystem, see baseline
+password_entry
+
+Usage:
+
+with recording(host) as recorder:
+    with phase('connect'):
+        ...
+    for entry in timed('parse', entries):
+        ...
+    count('bytes_received', len(data))
+report = recorder.as_dict()
+
+write_json_report('run.json', reports)
+write_prometheus_textfile('safestart.prom', reports)
+'''
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import json
+import os
+from threading import local
+from time import perf_counter, time
+
+import log
+l = log.getLogger(__name__)
+
+
+PROMETHEUS_PREFIX = 'safestart_'
+
+_current = local()
+
+
+class PhaseRecorder:
+    '''the exclusive time spent in every phase, and counters, for a host'''
+    def __init__(self, host):
+        self.host = host
+        self.phases = OrderedDict()
+        self.counters = OrderedDict()
+        self._stack = list()
+        self._started = perf_counter()
+
+    def _charge(self, name, seconds, calls):
+        totals = self.phases.setdefault(name, [0.0, 0])
+        totals[0] += seconds
+        totals[1] += calls
+
+    def enter(self, name):
+        now = perf_counter()
+        if self._stack:
+            # the enclosing phase stops the clock until this one is left
+            outer = self._stack[-1]
+            self._charge(outer[0], now - outer[1], 0)
+        self._stack.append([name, now])
+
+    def leave(self):
+        now = perf_counter()
+        name, started = self._stack.pop()
+        self._charge(name, now - started, 1)
+        if self._stack:
+            self._stack[-1][1] = now
+
+    def count(self, name, value):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        '''the recording as plain data, ready for json'''
+        phases = OrderedDict(
+            (name, dict(seconds=seconds, calls=calls))
+            for name, (seconds, calls) in self.phases.items())
+        counters = OrderedDict(self.counters)
+        transfer_seconds = sum(
+            self.phases.get(name, (0.0, 0))[0]
+            for name in ('transfer', 'remote_wait'))
+        if transfer_seconds > 0:
+            counters['bytes_received_per_second'] = (
+                counters.get('bytes_received', 0) / transfer_seconds)
+        return dict(host=self.host,
+                    elapsed=perf_counter() - self._started,
+                    phases=phases,
+                    counters=counters)
+
+
+def current():
+    '''the recorder of this thread, or None'''
+    return getattr(_current, 'recorder', None)
+
+
+@contextmanager
+def recording(host):
+    '''make a new PhaseRecorder current in this thread'''
+    recorder = PhaseRecorder(host)
+    previous = current()
+    _current.recorder = recorder
+    try:
+        yield recorder
+    finally:
+        _current.recorder = previous
+
+
+@contextmanager
+def phase(name):
+    '''time a phase'''
+    recorder = current()
+    if recorder is None:
+        yield
+        return
+    recorder.enter(name)
+    try:
+        yield
+    finally:
+        recorder.leave()
+
+
+def timed(name, iterable):
+    '''
+    pass the items of iterable through, timing the work of producing every
+    item as a phase
+    '''
+    recorder = current()
+    if recorder is None:
+        yield from iterable
+        return
+    iterator = iter(iterable)
+    enter, leave = recorder.enter, recorder.leave
+    while True:
+        enter(name)
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            leave()
+        yield item
+
+
+def count(name, value=1):
+    '''add value to a counter'''
+    recorder = current()
+    if recorder is not None:
+        recorder.count(name, value)
+
+
+def _write_atomically(filename, text):
+    '''
+    write the file next to its final name and rename it into place, so that
+    readers (like the node exporter) never see half of it
+    '''
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wt') as temp_file:
+        temp_file.write(text)
+    os.replace(temp_filename, filename)
+
+
+def write_json_report(filename, reports, started=None):
+    '''write the run report, a list of per-host dicts (see as_dict())'''
+    _write_atomically(filename, json.dumps(
+        dict(started=started, finished=time(), hosts=reports),
+        indent=2) + '\n')
+    l.info("Wrote the run report to %s", filename)
+
+
+def _label(value):
+    '''a Prometheus label value'''
+    return '"{}"'.format(str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+
+
+def write_prometheus_textfile(filename, reports):
+    '''
+    write the reports as a node exporter textfile collector file. Every
+    metric is a gauge of the last run.
+    '''
+    metrics = OrderedDict()
+
+    def _add(name, help_text, labels, value):
+        samples = metrics.setdefault(name, (help_text, list()))[1]
+        label_text = ','.join('{}={}'.format(key, _label(label_value))
+                              for key, label_value in labels)
+        samples.append('{}{}{} {!r}'.format(
+            PROMETHEUS_PREFIX, name,
+            '{' + label_text + '}' if label_text else '', float(value)))
+
+    for report in reports:
+        host = ('host', report['host'])
+        if 'status' in report:
+            _add('host_success', "1 if the host was unlocked or updated",
+                 [host, ('status', report['status'])],
+                 report['status'] in ('unlocked', 'updated'))
+        _add('host_seconds', "Wall time spent on the host", [host],
+             report['elapsed'])
+        for name, totals in report.get('phases', dict()).items():
+            _add('phase_seconds', "Time spent in a phase, excluding the "
+                 "phases nested in it", [host, ('phase', name)],
+                 totals['seconds'])
+            _add('phase_calls', "Times a phase was entered",
+                 [host, ('phase', name)], totals['calls'])
+        for name, value in report.get('counters', dict()).items():
+            _add(name, "Counter {}".format(name), [host], value)
+    _add('last_run_timestamp_seconds', "When the run finished", [], time())
+
+    lines = list()
+    for name, (help_text, samples) in metrics.items():
+        lines.append('# HELP {}{} {}'.format(PROMETHEUS_PREFIX, name,
+                                             help_text))
+        lines.append('# TYPE {}{} gauge'.format(PROMETHEUS_PREFIX, name))
+        lines.extend(samples)
+    _write_atomically(filename, '\n'.join(lines) + '\n')
+    l.info("Wrote the Prometheus metrics to %s", filename)
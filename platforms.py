@@ -2,34 +2,538 @@
 Platform specific classes
 '''
 
+from binascii import a2b_base64, hexlify
+from configparser import ConfigParser
 from fnmatch import translate as fnmatch_translate
 from gzip import GzipFile
+import hashlib
 from io import BytesIO
+from lzma import LZMAFile
+import os
 import re
+from shlex import quote
+import time
+from weakref import WeakKeyDictionary
+
+from paramiko.ssh_exception import SSHException
 
 import log
+import metrics
+from sshstuff import ConnectionLostError, RemoteCommandError
+from sumparse import parse_line
 l = log.getLogger(__name__)
 
 
-class Ubuntu_14_04:
+class StreamingGzipFile(GzipFile):
+    '''
+    decompress a stream as it arrives, closing the stream along with itself
+    '''
+    def __init__(self, stream):
+        super().__init__(fileobj=stream, mode='rb')
+        self._stream = stream
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._stream.close()
+
+
+class StreamingLZMAFile(LZMAFile):
+    '''StreamingGzipFile, for xz'''
+    def __init__(self, stream):
+        super().__init__(stream, mode='rb')
+        self._stream = stream
+
+    def close(self):
+        try:
+            super().close()
+        finally:
+            self._stream.close()
+
+
+class CompactSumsReader:
+    '''
+    decode the compact wire encoding of the sums (see COMPACT_AWK) back into
+    the sum program's lines as they arrive, closing the stream along with
+    itself. Every line is
+
+    [\\]{prefix length} {base64 digest} {rest of the name}{EOL}
+
+    where the name is the first prefix length bytes of the previous one,
+    followed by the rest.
+    '''
+    def __init__(self, stream):
+        self._stream = stream
+        self._lines = None
+
+    def __iter__(self):
+        previous = b''
+        for line in self._stream:
+            escape = b''
+            if line.startswith(b'\\'):
+                escape, line = b'\\', line[1:]
+            length, digest, rest = line.split(b' ', 2)
+            if rest.endswith(b'\n'):
+                rest = rest[:-1]
+            name = previous[:int(length)] + rest
+            previous = name
+            yield escape + hexlify(a2b_base64(digest)) + b'  ' + name + b'\n'
+
+    def read(self, size=-1):
+        '''the next decoded lines, about size bytes of them'''
+        if self._lines is None:
+            self._lines = iter(self)
+        lines = list()
+        total = 0
+        for line in self._lines:
+            lines.append(line)
+            total += len(line)
+            if size is not None and 0 <= size <= total:
+                break
+        return b''.join(lines)
+
+    def close(self):
+        self._stream.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ResumableSumsReader:
+    '''
+    read the sums from the remote spool of a detached scan (see RESUMABLE)
+    as they would be from get_remote_sums, a chunk of whole lines at a time.
+    When the connection goes away the client reconnects, and the spool is
+    read again from the line after the last one read - up to RESUME_RETRIES
+    times in a row, RESUME_DELAY seconds apart. Closing it removes the
+    spool.
+    '''
+    def __init__(self, platform, client, spool):
+        self._platform = platform
+        self._client = client
+        self._spool = spool
+        self._stream = None
+        # the bytes of the spool read so far, and the last line, if partial
+        self._offset = 0
+        self._rest = b''
+        self._failures = 0
+
+    def read(self, size=-1):
+        while True:
+            try:
+                if self._stream is None:
+                    self._open()
+                data = self._stream.read(size)
+            except ConnectionLostError as error:
+                self._lost(error)
+                continue
+            except RemoteCommandError:
+                raise
+            except (OSError, EOFError, SSHException) as error:
+                self._lost(error)
+                continue
+            self._failures = 0
+            if not data:
+                data, self._rest = self._rest, b''
+                self._offset += len(data)
+                return data
+            data = self._rest + data
+            end = data.rfind(b'\n') + 1
+            self._rest = data[end:]
+            if end:
+                self._offset += end
+                return data[:end]
+
+    def _connected(self):
+        '''the client, reconnected if the connection is gone'''
+        transport = self._client.get_transport()
+        if transport is None or not transport.is_active():
+            l.info("Reconnecting, to read the sums on from byte %d",
+                   self._offset)
+            self._client.reconnect()
+            metrics.count('reconnects')
+        return self._client
+
+    def _open(self):
+        '''read on from the offset'''
+        self._stream = self._platform.read_spool(self._connected(),
+                                                 self._spool, self._offset)
+
+    def _lost(self, error):
+        '''drop the stream and the partial line, or give up'''
+        self._close_stream()
+        self._rest = b''
+        self._failures += 1
+        if self._failures > self._platform.RESUME_RETRIES:
+            raise error
+        l.warning("Reading the sums failed (%r), retrying in %g seconds",
+                  error, self._platform.RESUME_DELAY)
+        time.sleep(self._platform.RESUME_DELAY)
+
+    def _close_stream(self):
+        stream, self._stream = self._stream, None
+        if stream is not None:
+            try:
+                stream.close()
+            except (OSError, EOFError, SSHException):
+                pass
+
+    def close(self):
+        self._close_stream()
+        try:
+            self._platform.remove_spool(self._connected(), self._spool)
+        except (OSError, EOFError, SSHException) as error:
+            l.warning("Could not remove the remote spool %s: %s",
+                      self._spool, error)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _sums_sample(size):
+    '''a made up, sorted listing of the sum program of about size bytes'''
+    lines = list()
+    total = 0
+    while total < size:
+        index = len(lines)
+        line = '{}  /usr/lib/package{}/lib{}/file{}.so\n'.format(
+            hashlib.sha256(str(index).encode('ascii')).hexdigest(),
+            index // 1000, index // 50, index)
+        lines.append(line)
+        total += len(line)
+    return ''.join(lines)
+
+
+# client --> the compression picked for its connection, see _codec()
+_probed_codecs = WeakKeyDictionary()
+
+
+def _positive_int(value):
+    '''convert a configuration value to an integer, which must be > 0'''
+    number = int(value)
+    if number < 1:
+        raise ValueError("Expected a positive number, got {}".format(value))
+    return number
+
+
+def _non_negative_int(value):
+    '''convert a configuration value to an integer, which must be >= 0'''
+    number = int(value)
+    if number < 0:
+        raise ValueError("Expected a number >= 0, got {}".format(value))
+    return number
+
+
+def _boolean(value):
+    '''convert a configuration value to a boolean, the ConfigParser way'''
+    try:
+        return ConfigParser.BOOLEAN_STATES[value.lower()]
+    except KeyError:
+        raise ValueError("Expected a boolean, got {}".format(value))
+
+
+def _word_list(value):
+    '''convert a configuration value to a tuple of words'''
+    return tuple(value.replace(',', ' ').split())
+
+
+def _directory_list(value):
+    '''convert a configuration value to a tuple of directory names'''
+    return tuple(name.rstrip('/') or '/' for name in _word_list(value))
+
+
+def _choice(*choices):
+    '''a conversion function accepting only one of the choices'''
+    def _convert(value):
+        if value not in choices:
+            raise ValueError("Expected one of {}, got {}".format(
+                ", ".join(choices), value))
+        return value
+    return _convert
+
+
+def _compile_excludes(file_globs, dirs):
+    '''
+    a single compiled pattern whose match() method matches the names of
+    files that fit any of the globs, or are anywhere under any of the dirs
+    '''
+    alternatives = [fnmatch_translate(glob) for glob in file_globs]
+    alternatives += [re.escape(dir_name.rstrip('/')) + '/'
+                     for dir_name in dirs]
+    if not alternatives:
+        # never matches
+        alternatives = ['(?!)']
+    return re.compile(('(?:' + '|'.join(alternatives) + ')').encode('utf-8'))
+
+
+class Platform:
+    '''
+    base class of the platforms. A platform is used as a class, holding its
+    settings as class attributes.
+    '''
+
+    # configuration file key --> (class attribute, conversion function)
+    SETTINGS = dict()
+
+    @classmethod
+    def configure(cls, settings):
+        '''
+        returns a subclass of the platform with the class attributes listed
+        in SETTINGS overridden by the matching keys in the settings mapping.
+        Keys that are not platform settings are ignored.
+        '''
+        overrides = dict()
+        for key, value in settings.items():
+            if key in cls.SETTINGS:
+                attr, convert = cls.SETTINGS[key]
+                overrides[attr] = convert(value)
+        if not overrides:
+            return cls
+        l.debug("%s settings: %s", cls.__name__, overrides)
+        return type(cls.__name__, (cls,), overrides)
+
+
+class Ubuntu_14_04(Platform):
 
     PIPE_NAME = "/lib/cryptsetup/passfifo"
-    SUM_PROGRAM_LOCAL = '/usr/bin/sha256sum'
+    # the SSH banner of the host waiting in its initramfs, see watch.py
+    INITRAMFS_BANNER = 'dropbear'
+    # the hash algorithms: name --> (local sum program, hashlib name, number
+    # of hex digits of the sum kept, or None for all of them). Whatever the
+    # algorithm, the program is copied to SUM_PROGRAM_REMOTE. 'auto' picks
+    # the fastest one the remote end runs, see benchmark_hashes().
+    HASH_ALGORITHMS = {
+        'sha256': ('/usr/bin/sha256sum', 'sha256', None),
+        'blake2b': ('/usr/bin/b2sum', 'blake2b', None),
+        'sha512-trunc': ('/usr/bin/sha512sum', 'sha512', 64),
+    }
+    HASH_ALGORITHM = 'sha256'
+    HASH_BENCHMARK_MB = 16
+    HASH_BENCHMARK_COMMAND = ('dd if=/dev/zero bs=1048576 count={mb} '
+                              '2> /dev/null | {prog} > /dev/null')
+    # keeps the first digits of the sums - names with a newline or a
+    # backslash get a leading backslash, see the sha256sum manual
+    TRIM_COMMAND = ("sed 's/^\\(\\\\\\{{0,1\\}}[0-9a-f]\\{{{digits}\\}}\\)"
+                    "[0-9a-f]*/\\1/' | ")
     SUM_PROGRAM_REMOTE = '/root/file_sum'
+    # the programs already on the remote end are checked with its own
+    # sha256sum (busybox's, in the initramfs) - never with the copy being
+    # checked, which could vouch for itself. Without one they are copied
+    # over every time.
+    PROGRAM_CHECK_COMMAND = 'sha256sum'
     PASSWORD_SCRIPT_REMOTE = '/root/pass_script'
-    SUM_COMMAND = ('find / -type f -xdev -exec {0} {{}} \; '
-                   '| gzip').format(SUM_PROGRAM_REMOTE).encode('ascii')
+    STAT_PROGRAM_LOCAL = '/usr/bin/stat'
+    STAT_PROGRAM_REMOTE = '/root/file_stat'
+    SCAN_ROOT = '/'
+    # where the names of the files to hash come from - the whole filesystem,
+    # or a NUL separated list of names on stdin
+    LIST_ALL_FILES = 'find {root} -xdev {prune}-type f {skip}-print0'
+    # with PRIORITY the PRIORITY_PATHS (files or directories, on the same
+    # filesystem as SCAN_ROOT) are hashed and compared first, then the rest
+    # of the filesystem. With FAIL_FAST the
+    # comparison stops, and the remote command is cancelled, on the first
+    # mismatch.
+    PRIORITY = False
+    PRIORITY_PATHS = (
+        '/boot',
+        '/bin',
+        '/sbin',
+        '/lib/cryptsetup',
+        '/lib/security',
+        '/lib/x86_64-linux-gnu/security',
+        '/etc/pam.d',
+        '/etc/ssh',
+        '/etc/crypttab',
+        '/usr/sbin/sshd',
+        '/usr/sbin/dropbear',
+        )
+    FAIL_FAST = False
+    LIST_STDIN = 'cat'
+    # the sums are sorted by file name locally, as they arrive, keeping at
+    # most about SORT_MEMORY_MB of them in memory and spilling the rest to
+    # disk - so the transfer and the parsing overlap the remote hashing. With
+    # REMOTE_SORT they are sorted on the remote end instead, which holds back
+    # every line until the whole scan is done, in the RAM (or the RAM backed
+    # /tmp) of the initramfs.
+    SORT_COMMAND = "LC_ALL=C sort -t ' ' -k 3"
+    REMOTE_SORT = False
+    SORT_MEMORY_MB = 64
+    # the sum program gets SUM_BATCH files per invocation. With SUM_JOBS > 1
+    # that many invocations run at once, each writing to its own file in
+    # SUM_SPOOL_DIR so that their lines can't interleave - appending, as a
+    # later invocation may get the pid, and the file, of an earlier one.
+    # This needs an xargs with -P on the remote end.
+    SUM_JOBS = 1
+    SUM_BATCH = 256
+    SUM_SPOOL_DIR = '/root/file_sums'
+    SUM_COMMAND_SERIAL = ('{list} | xargs -0 -n {batch} {prog} '
+                          '| {trim}{sort} | {output}')
+    SUM_COMMAND_PARALLEL = ('rm -rf {spool}; mkdir -p {spool} && '
+                            '{list} | xargs -0 -n {batch} -P {jobs} '
+                            'sh -c \'{prog} "$@" >> {spool}/$$\' sh; '
+                            'cat {spool}/* | {trim}{sort} | {output}; '
+                            'status=$?; rm -rf {spool}; exit $status')
+    # with RESUMABLE the sum command runs detached from the connection
+    # (nohup) into a spool starting with RESUMABLE_SPOOL, which is then read
+    # - from where the last read stopped if the connection goes away, see
+    # ResumableSumsReader. The scan writes its exit code to {spool}.status
+    # once the spool is complete.
+    RESUMABLE = False
+    RESUME_RETRIES = 5
+    RESUME_DELAY = 5.0
+    RESUMABLE_SPOOL = '/root/file_sums.resumable'
+    RESUMABLE_START_COMMAND = ('nohup sh -c {scan} < {input} > /dev/null '
+                               '2>&1 & echo $! > {spool}.pid')
+    RESUMABLE_SCAN = '({command}); echo $? > {spool}.status'
+    RESUMABLE_READ_COMMAND = (
+        'while [ ! -e {spool}.status ]; do '
+        'kill -0 "$(cat {spool}.pid)" 2> /dev/null || [ -e {spool}.status ] '
+        '|| {{ echo \'The scan is gone\' >&2; exit 1; }}; sleep 1; done; '
+        '[ "$(cat {spool}.status)" = 0 ] '
+        '|| {{ echo \'The scan failed\' >&2; exit 1; }}; '
+        'tail -c +{start} {spool} | {output}')
+    RESUMABLE_CLEANUP_COMMAND = ('for pid in {spool}.pid {spool}.*.pid; do '
+                                 'kill "$(cat "$pid" 2> /dev/null)" '
+                                 '2> /dev/null; done; rm -f {spool} {spool}.*')
+    # file metadata for incremental verification - only the files whose
+    # metadata differs from the database get hashed, with a full rehash at
+    # least every FULL_REHASH_DAYS
+    INCREMENTAL = False
+    FULL_REHASH_DAYS = 7.0
+    STAT_FORMAT = '%s %Y %Z %i %n\\0'
+    STAT_SORT_COMMAND = "LC_ALL=C sort -z -t ' ' -k 5"
+    STAT_COMMAND = ('{list} | xargs -0 -n {batch} {prog} '
+                    '--printf \'{format}\' | {sort} | {compress}')
+    # Merkle verification - the sorted sums are kept in MERKLE_SPOOL on the
+    # remote end, and only the digests of the directories (see the merkle
+    # module) are sent, descending only into the ones that differ
+    MERKLE = False
+    MERKLE_SPOOL = '/root/file_sums.sorted'
+    MERKLE_ROOT_COMMAND = '{prog} < {spool}'
+    # for every directory p, prints a 'F {sum line}' line per file directly in
+    # it (or, with all=1, under it) and a 'D {dir} {digest}  -' line per
+    # subdirectory. The digest comes from piping the subdirectory's lines
+    # through the sum program.
+    MERKLE_AWK = (
+        'BEGIN { p = ENVIRON["MERKLE_PREFIX"]; plen = length(p) }\n'
+        'function flush() {\n'
+        '    if (cur != "") { printf "D %s ", p cur; fflush(); close(cmd) }\n'
+        '    cur = ""\n'
+        '}\n'
+        '{\n'
+        '    name = substr($0, index($0, "  ") + 2)\n'
+        '    if (substr(name, 1, plen) != p) { if (seen) exit; next }\n'
+        '    seen = 1\n'
+        '    rest = substr(name, plen + 1)\n'
+        '    slash = index(rest, "/")\n'
+        '    if (all || slash == 0) { flush(); print "F " $0; next }\n'
+        '    child = substr(rest, 1, slash)\n'
+        '    if (child != cur) { flush(); cur = child }\n'
+        '    print $0 | cmd\n'
+        '}\n'
+        'END { flush() }\n')
+    MERKLE_QUERY_COMMAND = ('for p in {prefixes}; do '
+                            'printf \'P %s\\n\' "$p"; '
+                            'MERKLE_PREFIX="$p" '
+                            'awk -v all={all} -v cmd={prog} {script} {spool}; '
+                            'done | {compress}')
+    MERKLE_SUMS_COMMAND = 'cat {spool} | {output}'
+    MERKLE_CLEANUP_COMMAND = 'rm -f {spool}'
     SCRIPT_EXEC_COMMAND = '. {}'.format(PASSWORD_SCRIPT_REMOTE)
+    # the short commands go through a single RemoteAgent channel, which
+    # spools their output to files starting with AGENT_SPOOL. The programs
+    # copied over stay there for the next run, which only copies them again
+    # if the remote sum program says they changed.
+    AGENT_SPOOL = '/root/safestart-agent'
+    # files matching the EXCLUDE_FILES globs, and everything under the
+    # EXCLUDE_DIRS, are left out of the remote walk and of the database.
+    # The EXTRA_ ones come from the configuration file.
     EXCLUDE_FILES = (
         '*.pid',
         SUM_PROGRAM_REMOTE,
+        STAT_PROGRAM_REMOTE,
+        MERKLE_SPOOL,
+        AGENT_SPOOL + '.*',
+        RESUMABLE_SPOOL + '.*',
         )
-    EXCLUDE_PATTERNS = [re.compile(fnmatch_translate(g).encode('ascii'))
-                        for g in EXCLUDE_FILES]
-    EXCLUDE_PATTERN = re.compile(('(' + '|'.join([fnmatch_translate(g)
-                                                  for g
-                                                  in EXCLUDE_FILES]
-                                                 ) + ')').encode('ascii'))
+    EXCLUDE_DIRS = (
+        SUM_SPOOL_DIR,
+        )
+    EXTRA_EXCLUDE_FILES = ()
+    EXTRA_EXCLUDE_DIRS = ()
+    # the on-disk format of the tripwire database, text, binary or layered -
+    # the changes from one of the shared layers in LAYER_DIR, which is
+    # picked if it's within LAYER_MAX_CHANGES percent of the database
+    DB_FORMAT = 'text'
+    LAYER_DIR = 'baselines'
+    LAYER_MAX_CHANGES = 10
+    # updates append the changes to a journal, which is compacted into the
+    # database file once it's JOURNAL_COMPACT_MB
+    JOURNAL = False
+    JOURNAL_COMPACT_MB = 16
+    # the bulk output is compressed on the remote end by one of the
+    # COMPRESSORS: name --> (remote command, local decompressing stream
+    # class). 'auto' picks the one that gets the listing across the fastest
+    # once per connection, timing the remote end compressing
+    # COMPRESSION_PROBE_KB of made up sums against the link moving as much
+    # random data. With SSH_COMPRESSION the SSH transport compresses
+    # instead, for remote ends that are short on CPU or don't have gzip.
+    # SSH_KEEPALIVE is in seconds, 0 to turn keepalives off.
+    COMPRESSORS = {
+        'none': ('cat', None),
+        'gzip-1': ('gzip -1', StreamingGzipFile),
+        'gzip': ('gzip', StreamingGzipFile),
+        'xz': ('xz -1', StreamingLZMAFile),
+    }
+    COMPRESSION = 'gzip'
+    COMPRESSION_PROBE_KB = 1024
+    SSH_COMPRESSION = False
+    SSH_KEEPALIVE = 30
+    # with the compact WIRE_ENCODING the sums are sent as base64 digests,
+    # and names as the length of the prefix they share with the previous
+    # name and the rest, see CompactSumsReader
+    WIRE_ENCODING = 'text'
+    COMPACT_AWK = (
+        'BEGIN {\n'
+        '    hex = "0123456789abcdef"\n'
+        '    b64 = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+        '0123456789+/"\n'
+        '    for (i = 0; i < 16; i++) h[substr(hex, i + 1, 1)] = i\n'
+        '}\n'
+        '{\n'
+        '    esc = ""; line = $0\n'
+        '    if (substr(line, 1, 1) == "\\\\") {\n'
+        '        esc = "\\\\"; line = substr(line, 2)\n'
+        '    }\n'
+        '    sep = index(line, "  ")\n'
+        '    digest = substr(line, 1, sep - 1); name = substr(line, sep + 2)\n'
+        '    out = ""; dlen = length(digest)\n'
+        '    for (i = 1; i <= dlen; i += 6) {\n'
+        '        group = substr(digest, i, 6); glen = length(group); v = 0\n'
+        '        for (j = 1; j <= 6; j++)\n'
+        '            v = v * 16 + (j <= glen ? h[substr(group, j, 1)] : 0)\n'
+        '        chars = int((glen * 4 + 5) / 6)\n'
+        '        for (k = 0; k < 4; k++)\n'
+        '            out = out (k < chars ? substr(b64, '
+        'int(v / 2 ^ (18 - 6 * k)) % 64 + 1, 1) : "=")\n'
+        '    }\n'
+        '    m = length(prev) < length(name) ? length(prev) : length(name)\n'
+        '    n = 0\n'
+        '    while (n + 8 <= m && substr(prev, n + 1, 8) == '
+        'substr(name, n + 1, 8)) n += 8\n'
+        '    while (n < m && substr(prev, n + 1, 1) == '
+        'substr(name, n + 1, 1)) n++\n'
+        '    print esc n " " out " " substr(name, n + 1)\n'
+        '    prev = name\n'
+        '}\n')
+    COMPACT_COMMAND = 'LC_ALL=C awk {script}'
 
     PASSWORD_ENTRY_SCRIPT = """
 echo 'Stopping plymouth...'
@@ -51,31 +555,501 @@ exit
     INET_MATCH = re.compile(r'\s*inet\s(?P<ip>[^\s]*)'
                             r'.*\s+(?P<dev>[^\s]+)').match
 
+    SETTINGS = {
+        'hash_jobs': ('SUM_JOBS', _positive_int),
+        'hash_batch': ('SUM_BATCH', _positive_int),
+        'incremental': ('INCREMENTAL', _boolean),
+        'full_rehash_days': ('FULL_REHASH_DAYS', float),
+        'exclude_files': ('EXTRA_EXCLUDE_FILES', _word_list),
+        'exclude_dirs': ('EXTRA_EXCLUDE_DIRS', _directory_list),
+        'db_format': ('DB_FORMAT', _choice('text', 'binary', 'layered')),
+        'layer_dir': ('LAYER_DIR', str),
+        'layer_max_changes': ('LAYER_MAX_CHANGES', _non_negative_int),
+        'merkle': ('MERKLE', _boolean),
+        'compression': ('COMPRESSION', _choice('auto', *sorted(COMPRESSORS))),
+        'wire_encoding': ('WIRE_ENCODING', _choice('text', 'compact')),
+        'ssh_compression': ('SSH_COMPRESSION', _boolean),
+        'ssh_keepalive': ('SSH_KEEPALIVE', _non_negative_int),
+        'remote_sort': ('REMOTE_SORT', _boolean),
+        'resumable': ('RESUMABLE', _boolean),
+        'resume_retries': ('RESUME_RETRIES', _non_negative_int),
+        'resume_delay': ('RESUME_DELAY', float),
+        'sort_memory_mb': ('SORT_MEMORY_MB', _positive_int),
+        'journal': ('JOURNAL', _boolean),
+        'journal_compact_mb': ('JOURNAL_COMPACT_MB', float),
+        'hash': ('HASH_ALGORITHM', _choice('auto', *sorted(HASH_ALGORITHMS))),
+        'priority': ('PRIORITY', _boolean),
+        'priority_paths': ('PRIORITY_PATHS', _directory_list),
+        'fail_fast': ('FAIL_FAST', _boolean),
+        'program_check': ('PROGRAM_CHECK_COMMAND', str),
+    }
+
+    @classmethod
+    def hash_algorithm(cls, name=None):
+        '''
+        returns the (local sum program, hashlib name, hex digits kept) of the
+        algorithm, HASH_ALGORITHM by default
+        '''
+        name = name or cls.HASH_ALGORITHM
+        if name == 'auto':
+            raise ValueError("The hash algorithm has not been picked yet")
+        return cls.HASH_ALGORITHMS[name]
+
+    @classmethod
+    def _trim_command(cls):
+        '''the remote command truncating the sums, if the algorithm does'''
+        digits = cls.hash_algorithm()[2]
+        if digits is None:
+            return ''
+        return cls.TRIM_COMMAND.format(digits=digits)
+
+    @classmethod
+    def priority_paths(cls):
+        '''
+        the PRIORITY_PATHS under SCAN_ROOT, sorted and without the ones that
+        are under another one
+        '''
+        def _under(path, other):
+            return path == other or path.startswith(other.rstrip('/') + '/')
+
+        paths = list()
+        for path in sorted(cls.PRIORITY_PATHS):
+            if _under(path, cls.SCAN_ROOT) and not any(
+                    _under(path, other) for other in paths):
+                paths.append(path)
+        return tuple(paths)
+
+    @classmethod
+    def _sum_command(cls, output, from_stdin=False, sort=None, roots=None,
+                     prune=()):
+        '''
+        the remote command for the sums, sorted if REMOTE_SORT (or by the
+        given sort command) and piped into output. See _list_command for
+        roots and prune.
+        '''
+        template = cls.SUM_COMMAND_SERIAL
+        if cls.SUM_JOBS > 1:
+            template = cls.SUM_COMMAND_PARALLEL
+        return template.format(
+            list=cls._list_command(from_stdin, roots, prune),
+            prog=cls.SUM_PROGRAM_REMOTE,
+            trim=cls._trim_command(),
+            sort=sort or cls._sort_command(cls.SORT_COMMAND),
+            output=output,
+            spool=cls.SUM_SPOOL_DIR,
+            batch=cls.SUM_BATCH,
+            jobs=cls.SUM_JOBS).encode('ascii')
+
+    @classmethod
+    def _sort_command(cls, sort_command):
+        '''sort_command, or a no-op when sorting locally'''
+        return sort_command if cls.REMOTE_SORT else 'cat'
+
+    @classmethod
+    def _codec(cls, client):
+        '''the name of the compressor for the bulk output'''
+        if cls.SSH_COMPRESSION:
+            return 'none'
+        if cls.COMPRESSION != 'auto':
+            return cls.COMPRESSION
+        codec = _probed_codecs.get(client)
+        if codec is None:
+            codec = _probed_codecs[client] = cls.probe_compression(client)
+        return codec
+
+    @classmethod
+    def _compress_command(cls, codec):
+        '''the remote command compressing the bulk output'''
+        return cls.COMPRESSORS[codec][0]
+
+    @classmethod
+    def _decompress(cls, stream, codec):
+        '''decompress the output of _compress_command() as it arrives'''
+        stream_class = cls.COMPRESSORS[codec][1]
+        if stream_class is None:
+            return stream
+        return stream_class(stream)
+
+    @classmethod
+    def _sums_output(cls, codec):
+        '''the remote command encoding and compressing the sums'''
+        if cls.WIRE_ENCODING == 'compact':
+            return '{} | {}'.format(
+                cls.COMPACT_COMMAND.format(script=quote(cls.COMPACT_AWK)),
+                cls._compress_command(codec))
+        return cls._compress_command(codec)
+
+    @classmethod
+    def _decode_sums(cls, stream, codec):
+        '''decompress and decode the output of _sums_output()'''
+        stream = cls._decompress(stream, codec)
+        if cls.WIRE_ENCODING == 'compact':
+            return CompactSumsReader(stream)
+        return stream
+
+    @classmethod
+    def probe_compression(cls, client):
+        '''
+        returns the name of the compressor that gets the sums across the
+        fastest: the rate of the remote end compressing a sample, or of the
+        link moving its compressed size, whichever is lower
+        '''
+        agent = cls._agent(client)
+        size = cls.COMPRESSION_PROBE_KB * 1024
+        sample_file = cls.AGENT_SPOOL + '.sample'
+        sample = _sums_sample(size)
+        with metrics.phase('compression_probe'):
+            agent.request(('w', sample_file, sample))
+            started = time.perf_counter()
+            agent.run('true')
+            overhead = time.perf_counter() - started
+
+            started = time.perf_counter()
+            with client.exec_command_stream(
+                    'head -c {} /dev/urandom'.format(size).encode(
+                        'ascii')) as stream:
+                received = len(stream.read())
+            link_rate = received / (time.perf_counter() - started)
+            rates = dict(none=link_rate)
+            for codec, (command, _stream_class) in cls.COMPRESSORS.items():
+                if codec == 'none':
+                    continue
+                started = time.perf_counter()
+                out, _err, exit_code = agent.run('{} < {} | wc -c'.format(
+                    command, quote(sample_file)))
+                seconds = max(time.perf_counter() - started - overhead,
+                              1e-6)
+                if exit_code != 0 or not out.strip() or \
+                        int(out.split()[0]) == 0:
+                    l.debug("No %s on the remote end", codec)
+                    continue
+                ratio = int(out.split()[0]) / len(sample)
+                rates[codec] = min(len(sample) / seconds, link_rate / ratio)
+            agent.run('rm -f {}'.format(quote(sample_file)))
+        codec = max(rates, key=rates.get)
+        l.info("Compression: %s (%s)", codec, ", ".join(
+            "{} {:.1f} MB/s".format(name, rate / 1024 / 1024)
+            for name, rate in sorted(rates.items())))
+        return codec
+
+    @classmethod
+    def _list_command(cls, from_stdin=False, roots=None, prune=()):
+        '''
+        the remote command listing the files to work on - under the roots
+        (SCAN_ROOT by default) but not under prune. The excluded directories
+        are pruned from the walk and the excluded files skipped, so that
+        neither gets read or hashed.
+        '''
+        if from_stdin:
+            return cls.LIST_STDIN
+        exclude_files, exclude_dirs = cls.excludes()
+        pruned = tuple(exclude_dirs) + tuple(prune)
+        prune_text = ''
+        if pruned:
+            prune_text = '\\( {} \\) -prune -o '.format(
+                ' -o '.join('-path ' + quote(dir_name)
+                            for dir_name in pruned))
+        skip = ''.join('! -path {} '.format(quote(glob))
+                       for glob in exclude_files)
+        return cls.LIST_ALL_FILES.format(
+            root=' '.join(quote(root) for root in roots or (cls.SCAN_ROOT,)),
+            prune=prune_text,
+            skip=skip)
+
+    @classmethod
+    def excludes(cls):
+        '''returns the excluded file globs and directories'''
+        return (cls.EXCLUDE_FILES + cls.EXTRA_EXCLUDE_FILES,
+                cls.EXCLUDE_DIRS + cls.EXTRA_EXCLUDE_DIRS)
+
+    @classmethod
+    def exclude_pattern(cls):
+        '''
+        returns a compiled pattern whose match() method matches the excluded
+        file names (as bytes). It's compiled once per configured platform.
+        '''
+        pattern = cls.__dict__.get('_exclude_pattern')
+        if pattern is None:
+            pattern = _compile_excludes(*cls.excludes())
+            cls._exclude_pattern = pattern
+        return pattern
+
+    @classmethod
+    def _agent(cls, client):
+        '''the client's RemoteAgent'''
+        return client.agent(cls.AGENT_SPOOL)
+
+    @classmethod
+    def _remote_program_sums(cls, agent, remote_paths):
+        '''the sha256 sums of the remote files, by PROGRAM_CHECK_COMMAND'''
+        out, _err, _exit_code = agent.run('{} {}'.format(
+            cls.PROGRAM_CHECK_COMMAND,
+            ' '.join(quote(remote_path) for remote_path in remote_paths)))
+        sums = dict()
+        for line in out.decode('utf-8', 'replace').splitlines():
+            fields = line.split(None, 1)
+            if len(fields) == 2:
+                sums[fields[1].lstrip('*')] = fields[0]
+        return sums
+
+    @classmethod
+    def _ensure_programs(cls, client, *programs):
+        '''
+        make sure the sum program and the other (local_path, remote_path)
+        programs are on the remote end and executable, copying over only
+        the ones that aren't there already or differ
+        '''
+        sum_program = cls.hash_algorithm()[0]
+        programs = ((sum_program, cls.SUM_PROGRAM_REMOTE),) + tuple(
+            program for program in programs
+            if program[1] != cls.SUM_PROGRAM_REMOTE)
+        with metrics.phase('upload'):
+            expected = dict()
+            for local_path, remote_path in programs:
+                with open(local_path, 'rb') as local_file:
+                    expected[remote_path] = hashlib.sha256(
+                        local_file.read()).hexdigest()
+            agent = cls._agent(client)
+            remote_sums = cls._remote_program_sums(agent, list(expected))
+            stale = [remote_path for remote_path in expected
+                     if remote_sums.get(remote_path) !=
+                     expected[remote_path]]
+            if not stale:
+                l.debug("Programs already in place")
+                return True
+
+            for local_path, remote_path in programs:
+                if remote_path not in stale:
+                    continue
+                l.debug("Copying over %s", local_path)
+                if not client.send_file(local_path, remote_path):
+                    l.error("Could not copy %s to %s", local_path,
+                            remote_path)
+                    return False
+            _out, _err, exit_code = agent.run('chmod 755 {}'.format(
+                ' '.join(quote(remote_path) for remote_path in stale)))
+            return exit_code == 0
+
+    @classmethod
+    def benchmark_hashes(cls, client):
+        '''
+        time every hash algorithm whose sum program is available locally
+        over HASH_BENCHMARK_MB on the remote end, returns a mapping of
+        name --> seconds for the ones that ran
+        '''
+        agent = cls._agent(client)
+        timings = dict()
+        for name in sorted(cls.HASH_ALGORITHMS):
+            local_path = cls.hash_algorithm(name)[0]
+            if not os.path.exists(local_path):
+                l.debug("No %s, skipping %s", local_path, name)
+                continue
+            remote_path = '{}.{}'.format(cls.AGENT_SPOOL, name)
+            with metrics.phase('upload'):
+                if not client.send_file(local_path, remote_path):
+                    l.warning("Could not copy %s over", local_path)
+                    continue
+            agent.run('chmod 755 {}'.format(quote(remote_path)))
+            started = time.perf_counter()
+            _out, _err, exit_code = agent.run(
+                cls.HASH_BENCHMARK_COMMAND.format(mb=cls.HASH_BENCHMARK_MB,
+                                                  prog=quote(remote_path)))
+            seconds = time.perf_counter() - started
+            agent.run('rm -f {}'.format(quote(remote_path)))
+            if exit_code != 0:
+                l.debug("%s does not run on the remote end", name)
+                continue
+            l.info("%s: %.1f MB/s", name, cls.HASH_BENCHMARK_MB / seconds)
+            timings[name] = seconds
+        return timings
+
+    @classmethod
+    def get_remote_sums(cls, client, names=None, roots=None, prune=()):
+        '''
+        returns a file object containing a hash  filename\n database, sorted
+        by file name, for all the regular files - or only for the given file
+        names, or only for the files under roots and not under prune. The
+        data is decompressed as it arrives from the remote end, and reading
+        past its end raises RemoteCommandError if the remote command failed.
+        '''
+        if cls.RESUMABLE:
+            spool = cls.start_detached_sums(client, names, roots, prune)
+            if spool is None:
+                return None
+            return ResumableSumsReader(cls, client, spool)
+        if not cls._ensure_programs(client):
+            return None
+        # stream the result of running the checksum on the files
+        i_buf = None
+        if names is None:
+            l.debug("Applying sum to regular files, %d job(s)", cls.SUM_JOBS)
+        else:
+            l.debug("Applying sum to %d files, %d job(s)",
+                    len(names), cls.SUM_JOBS)
+            i_buf = BytesIO(b''.join(name + b'\0' for name in names))
+        codec = cls._codec(client)
+        stream = client.exec_command_stream(
+            cls._sum_command(cls._sums_output(codec),
+                             from_stdin=names is not None, roots=roots,
+                             prune=prune), i_buf)
+
+        # unzip on the fly
+        return cls._decode_sums(stream, codec)
+
     @classmethod
-    def get_remote_sums(cls, client):
-        '''returns a file object containing a hash\tfilename\n database'''
-        l.debug("Copying over sum program")
-        client.send_file(cls.SUM_PROGRAM_LOCAL, cls.SUM_PROGRAM_REMOTE)
-        client.chmod(cls.SUM_PROGRAM_REMOTE, "755")
-        # get the result of running the checksum on all regular files
-        l.debug("Applying sum to regular files")
-        cmd = cls.SUM_COMMAND
+    def start_detached_sums(cls, client, names=None, roots=None, prune=()):
+        '''
+        start hashing the files (see get_remote_sums) detached from the
+        connection, into a new remote spool. Returns the spool's name, or
+        None if the scan could not be started.
+        '''
+        if not cls._ensure_programs(client):
+            return None
+        agent = cls._agent(client)
+        # the spools of scans gone astray
+        agent.run(cls.RESUMABLE_CLEANUP_COMMAND.format(
+            spool=cls.RESUMABLE_SPOOL))
+        spool = '{}.{}'.format(cls.RESUMABLE_SPOOL, os.urandom(4).hex())
+        names_input = '/dev/null'
+        if names is not None:
+            l.debug("Applying sum to %d files into %s, detached",
+                    len(names), spool)
+            names_input = spool + '.names'
+            if not client.send_file_obj(
+                    BytesIO(b''.join(name + b'\0' for name in names)),
+                    names_input):
+                return None
+        else:
+            l.debug("Applying sum to regular files into %s, detached", spool)
+        command = cls._sum_command('cat > ' + spool,
+                                   from_stdin=names is not None,
+                                   roots=roots, prune=prune).decode('ascii')
+        scan = cls.RESUMABLE_SCAN.format(command=command, spool=spool)
+        _out, _err, exit_code = agent.run(cls.RESUMABLE_START_COMMAND.format(
+            scan=quote(scan), input=names_input, spool=spool))
+        if exit_code != 0:
+            return None
+        return spool
 
-        (o_buf, e_buf, exit_code) = client.exec_command_output_only(cmd)
-        # delete sum program
-        client.rm(cls.SUM_PROGRAM_REMOTE)
+    @classmethod
+    def read_spool(cls, client, spool, offset=0):
+        '''
+        a file object of the detached scan's spool from the offset on, once
+        the scan is done - see get_remote_sums
+        '''
+        codec = cls._codec(client)
+        command = cls.RESUMABLE_READ_COMMAND.format(
+            spool=spool, start=offset + 1, output=cls._sums_output(codec))
+        return cls._decode_sums(client.exec_command_stream(
+            command.encode('ascii')), codec)
+
+    @classmethod
+    def remove_spool(cls, client, spool):
+        '''stop the detached scan if it's still running, remove its spool'''
+        cls._agent(client).run(cls.RESUMABLE_CLEANUP_COMMAND.format(
+            spool=spool))
 
-        # error checking
-        if not exit_code == 0:
-            l.error("Could not retrieve sums. Error: %s",
-                    e_buf.getvalue().decode('utf-8'))
+    @classmethod
+    def get_remote_stats(cls, client):
+        '''
+        returns a file object containing a size mtime ctime inode filename\\0
+        listing of all the regular files, the names raw - not escaped
+        '''
+        if not cls._ensure_programs(client, (cls.STAT_PROGRAM_LOCAL,
+                                             cls.STAT_PROGRAM_REMOTE)):
             return None
+        l.debug("Listing the metadata of regular files")
+        codec = cls._codec(client)
+        command = cls.STAT_COMMAND.format(list=cls._list_command(),
+                                          batch=cls.SUM_BATCH,
+                                          prog=cls.STAT_PROGRAM_REMOTE,
+                                          format=cls.STAT_FORMAT,
+                                          sort=cls._sort_command(
+                                              cls.STAT_SORT_COMMAND),
+                                          compress=cls._compress_command(
+                                              codec))
+        stream = client.exec_command_stream(command.encode('ascii'))
+        return cls._decompress(stream, codec)
 
-        # wrap the file in a zip object to unzip
-        o_buf.seek(0)
-        unzipped_out = GzipFile(fileobj=o_buf)
+    @classmethod
+    def merkle_scan(cls, client):
+        '''
+        hash all the regular files into the sorted remote spool, returns
+        True if successful
+        '''
+        if not cls._ensure_programs(client):
+            return False
+        l.debug("Applying sum to regular files into %s", cls.MERKLE_SPOOL)
+        # the directory digests need the spool sorted, whatever REMOTE_SORT
+        command = cls._sum_command('cat > ' + cls.MERKLE_SPOOL,
+                                   sort=cls.SORT_COMMAND)
+        return cls._agent(client).run(command)[2] == 0
+
+    @classmethod
+    def merkle_root(cls, client):
+        '''the digest of the whole remote spool'''
+        command = cls.MERKLE_ROOT_COMMAND.format(prog=cls.SUM_PROGRAM_REMOTE,
+                                                 spool=cls.MERKLE_SPOOL)
+        out, _err, _exit_code = cls._agent(client).run(command)
+        return out.split()[0]
+
+    @classmethod
+    def _merkle_query(cls, client, prefixes, all_files):
+        '''run the MERKLE_AWK script for the directories'''
+        codec = cls._codec(client)
+        command = cls.MERKLE_QUERY_COMMAND.format(
+            prefixes=' '.join(quote(os.fsdecode(prefix))
+                              for prefix in prefixes),
+            all=1 if all_files else 0,
+            prog=cls.SUM_PROGRAM_REMOTE,
+            script=quote(cls.MERKLE_AWK),
+            spool=cls.MERKLE_SPOOL,
+            compress=cls._compress_command(codec))
+        return cls._decompress(client.exec_command_stream(
+            os.fsencode(command)), codec)
+
+    @classmethod
+    def merkle_children(cls, client, prefixes):
+        '''
+        returns a mapping of every directory in prefixes to a tuple of its
+        subdirectories' digests (a mapping of dir --> digest) and the
+        (file_name, file_sum) tuples of the files directly in it
+        '''
+        children = dict()
+        with cls._merkle_query(client, prefixes, False) as stream:
+            for line in stream:
+                kind, rest = line[:2], line[2:].rstrip(b'\n')
+                if kind == b'P ':
+                    dirs, files = children[rest] = (dict(), list())
+                elif kind == b'D ':
+                    dir_name, digest, _empty, _dash = rest.rsplit(b' ', 3)
+                    dirs[dir_name] = digest
+                else:
+                    files.append(parse_line(rest)[:2])
+        return children
 
-        return unzipped_out
+    @classmethod
+    def merkle_subtree(cls, client, prefix):
+        '''the (file_name, file_sum) tuples of all the files under prefix'''
+        with cls._merkle_query(client, [prefix], True) as stream:
+            for line in stream:
+                if line.startswith(b'F '):
+                    yield parse_line(line[2:])[:2]
+
+    @classmethod
+    def merkle_sums(cls, client):
+        '''a file object of the whole remote spool, see get_remote_sums'''
+        codec = cls._codec(client)
+        command = cls.MERKLE_SUMS_COMMAND.format(
+            spool=cls.MERKLE_SPOOL, output=cls._sums_output(codec))
+        return cls._decode_sums(client.exec_command_stream(
+            command.encode('ascii')), codec)
+
+    @classmethod
+    def merkle_cleanup(cls, client):
+        '''remove the remote spool'''
+        command = cls.MERKLE_CLEANUP_COMMAND.format(spool=cls.MERKLE_SPOOL)
+        return cls._agent(client).run(command)[2] == 0
 
     @classmethod
     def _get_ip_and_dev(cls, client):
@@ -84,17 +1058,16 @@ exit
         device it's on
         '''
 
-        (out_f,
+        (out,
          _err,
-         ret_code) = client.exec_command_output_only(cls.CMD_IP_ADDR_LIST)
+         ret_code) = cls._agent(client).run(cls.CMD_IP_ADDR_LIST)
 
         if ret_code > 0:
             l.error("Failed to retreive remote IP / dev")
             return None, None
 
         # parse the output
-        out_f.seek(0)
-        for line in out_f:
+        for line in out.splitlines():
             match = cls.INET_MATCH(line.decode('utf-8'))
             if match:
                 ip = match.group('ip')
@@ -122,15 +1095,27 @@ exit
                                                   password=password,
                                                   pipe_name=cls.PIPE_NAME)
 
-        client.send_file_obj(BytesIO(script.encode('utf-8')),
-                             cls.PASSWORD_SCRIPT_REMOTE)
-        (out_f,
-         _err_f,
-         _ret_code) = client.exec_command_output_only(cls.SCRIPT_EXEC_COMMAND)
+        (_out, _err, exit_code), = cls._agent(client).request(
+            ('w', cls.PASSWORD_SCRIPT_REMOTE, script))
+        if exit_code != 0:
+            l.error("Could not write the password entry script")
+            return False
+
+        # the script takes the network down, so it runs on a channel of its
+        # own and the connection going away while it runs is its success
+        try:
+            (out,
+             _err,
+             _ret_code) = client.exec_command_output_only(
+                 cls.SCRIPT_EXEC_COMMAND)
+        except (OSError, EOFError, SSHException) as error:
+            l.debug("The connection went away running the script: %s",
+                    error)
+            return True
 
         l.debug("Password entry script complete.")
 
-        for line in out_f:
+        for line in out.getvalue().splitlines():
             l.debug('Remote said: %s', line.decode('utf-8'))
 
         return True
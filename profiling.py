@@ -0,0 +1,117 @@
+'''
+Profile the phases of a run, to find out where the time and the memory of
+a slow host go.
+
+Once enabled, every phase is run under its own cProfile profiler, and
+tracemalloc compares the memory allocated at its start and at its end. The
+reports go to the directory given, next to the log file:
+
+safestart.profile.{host}.{phase}.pstats     - python -m pstats {file}
+safestart.profile.{host}.{phase}.allocs     - the top allocations
+
+with 'main' for the host of the phases outside of any host. The remote
+scan streams, so its phases are scan_start - uploading the programs and
+starting the remote commands - and then scan_compare or scan_update, which
+take in the sums as they arrive and compare or write them. cProfile only
+sees the thread it runs in, so the time the channel pumps and the filter
+threads take shows up as the phase waiting on them - and tracemalloc sees
+every thread, so the hosts are to be run one at a time.
+
+Until enabled phase() does nothing but check for it.
+
+Usage:
+
+enable('/var/log')
+with phase('scan_compare', host):
+    ...
+'''
+
+import cProfile
+from contextlib import contextmanager
+import os
+import tracemalloc
+
+import log
+l = log.getLogger(__name__)
+
+
+PROFILE_PATTERN = 'safestart.profile.{}.{}'
+STATS_SUFFIX = '.pstats'
+ALLOCS_SUFFIX = '.allocs'
+TRACEBACK_FRAMES = 8
+TOP_ALLOCATIONS = 30
+MAIN_HOST = 'main'
+
+_directory = None
+
+
+def enable(directory):
+    '''profile the phases from now on, writing the reports to the directory'''
+    global _directory
+    _directory = directory
+    if not tracemalloc.is_tracing():
+        tracemalloc.start(TRACEBACK_FRAMES)
+    l.info("Profiling the phases into %s", directory)
+
+
+def is_enabled():
+    '''are the phases being profiled'''
+    return _directory is not None
+
+
+def _snapshot():
+    '''the allocations so far, without tracemalloc's own'''
+    return tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+        tracemalloc.Filter(False, '<unknown>'),
+    ))
+
+
+@contextmanager
+def phase(name, host=None):
+    '''profile the phase of the host, if enabled'''
+    if _directory is None:
+        yield
+        return
+    before = _snapshot()
+    # the peak of the phase alone needs python 3.9, before it's only known
+    # how much the phase grew
+    has_peak = hasattr(tracemalloc, 'reset_peak')
+    if has_peak:
+        tracemalloc.reset_peak()
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        peak = tracemalloc.get_traced_memory()[1] if has_peak else None
+        after = _snapshot()
+        _write_reports(PROFILE_PATTERN.format(host or MAIN_HOST, name),
+                       profile, before, after, peak)
+
+
+def _write_reports(name, profile, before, after, peak):
+    '''
+    write the pstats file and the allocations report of a phase, peak is
+    None when it isn't known
+    '''
+    base_filename = os.path.join(_directory, name)
+    profile.dump_stats(base_filename + STATS_SUFFIX)
+
+    differences = after.compare_to(before, 'traceback')
+    growth = sum(difference.size_diff for difference in differences)
+    with open(base_filename + ALLOCS_SUFFIX, 'wt') as allocs_file:
+        if peak is not None:
+            allocs_file.write("peak {} KiB, ".format(peak // 1024))
+        allocs_file.write("grew by {} KiB\n\n".format(growth // 1024))
+        for difference in differences[:TOP_ALLOCATIONS]:
+            allocs_file.write("{:+d} KiB in {:+d} blocks, {} KiB now\n".format(
+                difference.size_diff // 1024, difference.count_diff,
+                difference.size // 1024))
+            for line in difference.traceback.format(most_recent_first=True):
+                allocs_file.write(line + '\n')
+            allocs_file.write('\n')
+    l.debug("Wrote the profile of %s to %s%s", name, base_filename,
+            STATS_SUFFIX)
@@ -6,10 +6,16 @@ from collections import namedtuple
 from configparser import ConfigParser
 import os
 import sys
+from time import time
 
+from baseline import BaselineBuilder
+import fleet
+import metrics
 import platforms
-from sshstuff import DBSSHClient, AutoAddPolicy
+import profiling
+from sshpool import ConnectionPool
 from tripwire import TripwireDatabase
+import watch
 
 import log
 l = log.getLogger(__name__)
@@ -83,6 +89,13 @@ PLATFORM_FIELD = 'platform'
 PASSWORD_FIELD = 'password'
 KNOWN_HOSTS = 'known_hosts'
 DEFAULT_KNOWN_HOSTS = 'known_hosts.db'
+PARALLEL = 'parallel'
+METRICS = 'metrics'
+PROMETHEUS = 'prometheus'
+WATCH = 'watch'
+PROFILE = 'profile'
+BUILD_BASELINE = 'build-baseline'
+HOSTS = 'hosts'
 
 HostConfig = namedtuple(typename='HostConfig',
                         field_names=[HOST_FIELD,
@@ -92,11 +105,14 @@ HostConfig = namedtuple(typename='HostConfig',
                                      PASSWORD_FIELD])
 
 
+def config_file_name(args):
+    '''return the configuration file'''
+    return args.get(CONFIG) or DEFAULT_CONFIG
+
+
 def load_config_file(args):
     '''load data from a configuration file'''
-    config_file = 'safestart.conf'
-    if CONFIG in args:
-        config_file = args[CONFIG]
+    config_file = config_file_name(args)
 
     conf = ConfigParser()
     conf.read(config_file)
@@ -107,6 +123,8 @@ def load_config_file(args):
         username = conf.get(section, USER_FIELD, fallback='root')
         key_file = conf.get(section, KEYFILE_FIELD)
         platform = getattr(platforms, conf.get(section, PLATFORM_FIELD))
+        # any platform specific settings in the section
+        platform = platform.configure(dict(conf.items(section)))
         password = conf.get(section, PASSWORD_FIELD)
         hosts.append(HostConfig(host, username, key_file, platform, password))
 
@@ -121,48 +139,122 @@ def known_hosts(args):
         return os.path.abspath(DEFAULT_KNOWN_HOSTS)
 
 
-def main(args):
-    '''do it'''
-    # get some configuration going
-    hosts_file = known_hosts(args)
-    hosts_config = load_config_file(args)
-
-    # do for all hosts
-    for host_config in hosts_config:
-        client = DBSSHClient()
-        if os.path.exists(hosts_file):
-            client.load_host_keys(hosts_file)
-        client.set_missing_host_key_policy(AutoAddPolicy())
-        client.connect(hostname=host_config.host,
-                       username=host_config.username,
-                       key_filename=host_config.key_file)
-        client.save_host_keys(hosts_file)
-
+def unlock_host(host_config, args, pool):
+    '''
+    verify a single host and enter its password.
+    returns a (status, message) tuple, see fleet.STATUSES
+    '''
+    host = host_config.host
+    with profiling.phase('connect', host):
+        client = pool.get(host_config)
+    try:
         if SKIP in args:
             l.info("Skipping tripwire checks")
         else:
-            twdb = TripwireDatabase(client, host_config.host,
-                                    host_config.platform)
-            twdb.get_remote_sums()
+            # the sums stream in as they are compared or written, so the
+            # remote scan only starts here
+            with profiling.phase('scan_start', host):
+                twdb = TripwireDatabase(client, host, host_config.platform)
+                twdb.get_remote_sums(updating=UPDATE in args)
 
             if UPDATE in args:
-                twdb.update_database()
-                return
+                with profiling.phase('scan_update', host):
+                    twdb.update_database()
+                return fleet.UPDATED, "database updated"
 
             l.debug("Comparing remote sums to database")
-            diff = twdb.compare_databases()
+            with profiling.phase('scan_compare', host):
+                diff = twdb.compare_databases()
             if len(diff) == 0:
                 l.debug("Compare successful")
             else:
                 l.error("Compare failed, differences to follow")
                 for action, file_name in diff:
                     l.error("%s %s", action, file_name)
-                return
+                return fleet.FAILED, "{} differences".format(len(diff))
+
+        with metrics.phase('password_entry'), \
+                profiling.phase('password_entry', host):
+            entered = host_config.platform.enter_password(
+                client, host_config.password)
+        if not entered:
+            return fleet.FAILED, "password entry failed"
+        # the host takes its network down for the password entry
+        pool.discard(host_config)
+        return fleet.UNLOCKED, ""
+    except Exception:
+        # don't reuse a connection in an unknown state
+        pool.discard(host_config)
+        raise
+
+
+def run_hosts(hosts_config, args):
+    '''verify and unlock the hosts, returns the fleet.HostResult list'''
+    hosts_file = known_hosts(args)
+    concurrency = int(args.get(PARALLEL) or 1)
+    if profiling.is_enabled() and concurrency > 1:
+        # the allocations of the hosts would be mixed up
+        l.warning("Profiling, running the hosts one at a time")
+        concurrency = 1
+    started = time()
+
+    # do for all hosts, sharing the connections between the phases
+    with ConnectionPool(hosts_file) as pool:
+        results = fleet.run_fleet(
+            hosts_config,
+            lambda host_config: unlock_host(host_config, args, pool),
+            concurrency)
+    fleet.log_summary(results)
+
+    with profiling.phase('reports'):
+        if args.get(METRICS):
+            metrics.write_json_report(args[METRICS], fleet.reports(results),
+                                      started)
+        if args.get(PROMETHEUS):
+            metrics.write_prometheus_textfile(args[PROMETHEUS],
+                                              fleet.reports(results))
+    return results
+
+
+def build_baselines(hosts_config, args):
+    '''
+    write the databases of the hosts (or of the ones listed in the hosts
+    argument) from the copy of their filesystem in the build-baseline
+    directory, returns the fleet.HostResult list
+    '''
+    if args.get(HOSTS):
+        names = set(args[HOSTS].split(','))
+        hosts_config = [host_config for host_config in hosts_config
+                        if host_config.host in names]
+    builder = BaselineBuilder(args[BUILD_BASELINE],
+                              int(args.get(PARALLEL) or 0) or None)
+    # one host at a time, the builder hashes with all the cores
+    results = fleet.run_fleet(hosts_config, builder.build)
+    fleet.log_summary(results)
+    return results
+
 
-        host_config.platform.enter_password(client, host_config.password)
-        client.close()
+def main(args):
+    '''do it'''
+    if PROFILE in args:
+        profiling.enable(os.path.dirname(os.path.abspath(log.log_file_path)))
+
+    if WATCH in args:
+        # a daemon, running the hosts as they reboot
+        return watch.watch(config_file_name(args),
+                           lambda: load_config_file(args),
+                           lambda hosts_config: run_hosts(hosts_config, args),
+                           float(args[WATCH] or watch.INTERVAL))
+
+    with profiling.phase('config'):
+        hosts_config = load_config_file(args)
+    if args.get(BUILD_BASELINE):
+        results = build_baselines(hosts_config, args)
+    else:
+        results = run_hosts(hosts_config, args)
+    return 0 if fleet.all_succeeded(results) else 1
 
 
 if __name__ == '__main__':
     args = parse_arguments(sys.argv[1:])
-    main(args)
+    sys.exit(main(args))
@@ -0,0 +1,108 @@
+'''
+A pool of connected SSH clients, one per (host, username, key file).
+
+Every remote operation runs as its own exec channel - a channel can't run a
+second command once its first one is done - but all the channels of a host
+share one transport, so the key exchange and authentication happen once per
+host rather than once per verification. A transport that died (the host
+rebooted, the network went away) is noticed the next time the client is
+asked for, and replaced by a fresh connection.
+
+The known hosts file is read once into a HostKeyStore that all the clients
+share. A connection that added a key writes the file back straight away,
+from the thread that asked for it - still inside that host's metrics
+recording, so the save shows up in its report as host_key_save.
+
+Usage:
+
+with ConnectionPool('known_hosts.db') as pool:
+    client = pool.get(host_config)
+    ...
+    pool.discard(host_config)   # when the host is known to go away
+'''
+
+from threading import Lock
+
+from knownhosts import HostKeyStore
+from sshstuff import DBSSHClient, AutoAddPolicy
+
+import log
+import metrics
+l = log.getLogger(__name__)
+
+
+def _pool_key(host_config):
+    return (host_config.host, host_config.username, host_config.key_file)
+
+
+def _is_alive(client):
+    '''True if the client's transport is still usable'''
+    transport = client.get_transport()
+    return transport is not None and transport.is_active()
+
+
+class ConnectionPool:
+    '''
+    connected DBSSHClient instances, reused for as long as their transports
+    stay up, sharing one HostKeyStore
+    '''
+    def __init__(self, hosts_file):
+        self._host_keys = HostKeyStore(hosts_file)
+        self._clients = dict()
+        self._lock = Lock()
+
+    def _connect(self, host_config):
+        '''a new, connected client'''
+        platform = host_config.platform
+        client = DBSSHClient()
+        client.use_host_keys(self._host_keys)
+        client.set_missing_host_key_policy(AutoAddPolicy())
+        with metrics.phase('connect'):
+            client.connect(hostname=host_config.host,
+                           username=host_config.username,
+                           key_filename=host_config.key_file,
+                           compress=platform.SSH_COMPRESSION,
+                           keepalive=platform.SSH_KEEPALIVE)
+        return client
+
+    def get(self, host_config):
+        '''a connected client for the host, reconnecting if needed'''
+        key = _pool_key(host_config)
+        with self._lock:
+            client = self._clients.pop(key, None)
+        if client is not None:
+            if _is_alive(client):
+                l.debug("Reusing the connection to %s", host_config.host)
+            else:
+                l.info("Connection to %s is gone, reconnecting",
+                       host_config.host)
+                client.close()
+                client = None
+        if client is None:
+            l.debug("Connecting to %s", host_config.host)
+            client = self._connect(host_config)
+            self._host_keys.flush()
+        with self._lock:
+            self._clients[key] = client
+        return client
+
+    def discard(self, host_config):
+        '''close the host's connection, if there is one'''
+        with self._lock:
+            client = self._clients.pop(_pool_key(host_config), None)
+        if client is not None:
+            client.close()
+
+    def close_all(self):
+        '''close all the connections, and save any host keys still pending'''
+        with self._lock:
+            clients, self._clients = list(self._clients.values()), dict()
+        for client in clients:
+            client.close()
+        self._host_keys.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close_all()
@@ -17,10 +17,20 @@
 
     client.send_file('xxx', 'yyy')
     client.receive_file('xxx', 'yyy')
+
+    # read the output of a long running command while it's still running
+    with client.exec_command_stream('find /') as stream:
+        for line in stream:
+            print(line)
+
+    # many short commands over a single channel
+    agent = client.agent('/tmp/agent')
+    (out, err, exit_code), = agent.request(('x', 'ls /'))
 """
 
-from io import BytesIO
-from threading import Event, Thread
+from io import BufferedReader, BytesIO, RawIOBase
+from selectors import DefaultSelector, EVENT_READ
+from shlex import quote
 from time import time
 
 from paramiko.client import (SSHClient,
@@ -29,9 +39,15 @@ from paramiko.client import (SSHClient,
                              WarningPolicy)
 
 import log
+import metrics
 l = log.getLogger(__name__)
 
-BUF_SIZE = 512
+# I/O sizes follow the channel's window, within these limits
+MIN_BUF_SIZE = 32768
+MAX_BUF_SIZE = 4 * 1024 * 1024
+STREAM_BUF_SIZE = 65536
+# how long to wait for the send window to open before checking again
+SEND_WINDOW_POLL = 0.005
 
 # avoid PEP8 "imported but unused" warning
 assert AutoAddPolicy
@@ -39,6 +55,301 @@ assert RejectPolicy
 assert WarningPolicy
 
 
+def _buf_size(window_size):
+    """an I/O size that follows the window size, within the limits"""
+    return max(MIN_BUF_SIZE, min(MAX_BUF_SIZE, window_size))
+
+
+class RemoteCommandError(IOError):
+    """a streamed remote command finished with a non-zero exit code"""
+
+
+class ConnectionLostError(RemoteCommandError):
+    """the connection went away before a streamed remote command finished"""
+
+
+class ChannelPump:
+    """
+    a single threaded I/O engine for a remote command. stdin is fed from a
+    file object whenever the channel's send window allows, while stdout and
+    stderr are read as they arrive - waiting on the channel's fileno(), which
+    paramiko signals for stdout, stderr and EOF alike.
+    """
+
+    def __init__(self, chan, command, i_buf=None, e_buf=None):
+        self._chan = chan
+        self._command = command
+        self._i_buf = i_buf
+        self._pending = b''
+        self._input_done = False
+        self.e_buf = BytesIO() if e_buf is None else e_buf
+        self.exit_code = None
+        self.bytes_sent = self.bytes_received = 0
+        self._start_time = time()
+        self._selector = DefaultSelector()
+        self._selector.register(chan.fileno(), EVENT_READ)
+        chan.settimeout(0.0)
+        if i_buf is None:
+            self._end_input()
+
+    def _end_input(self):
+        self._input_done = True
+        self._pending = b''
+        if not (self._chan.closed or self._chan.eof_received):
+            self._chan.shutdown_write()
+
+    def _send_some(self):
+        """send as much input as the send window takes without blocking"""
+        chan = self._chan
+        while not self._input_done and chan.send_ready():
+            if chan.closed or chan.eof_received:
+                # the remote command is gone, nobody wants the rest
+                self._end_input()
+                break
+            if len(self._pending) == 0:
+                self._pending = memoryview(
+                    self._i_buf.read(_buf_size(chan.out_window_size)))
+                if len(self._pending) == 0:
+                    self._end_input()
+                    break
+            sent = chan.send(self._pending)
+            self._pending = self._pending[sent:]
+            self.bytes_sent += sent
+
+    def _drain_stderr(self):
+        """keep stderr from filling the channel window"""
+        chan = self._chan
+        while chan.recv_stderr_ready():
+            self.e_buf.write(chan.recv_stderr(
+                _buf_size(chan.in_window_size)))
+
+    def read(self, size=None):
+        """the next chunk of stdout, up to size bytes. b'' once it's done"""
+        with metrics.phase('transfer'):
+            return self._read(size)
+
+    def _read(self, size):
+        chan = self._chan
+        while True:
+            self._send_some()
+            self._drain_stderr()
+            if chan.recv_ready():
+                data = chan.recv(size or _buf_size(chan.in_window_size))
+                self.bytes_received += len(data)
+                return data
+            if chan.eof_received or chan.closed:
+                # closed without an EOF when the transport went away
+                return b''
+            # while input is waiting for the send window, only doze off
+            timeout = None if self._input_done else SEND_WINDOW_POLL
+            with metrics.phase('remote_wait'):
+                self._selector.select(timeout)
+
+    def finish(self):
+        """stdout is done - collect the rest of stderr and the exit code"""
+        self._drain_stderr()
+        self.exit_code = self._chan.recv_exit_status()
+        self._selector.close()
+        metrics.count('bytes_sent', self.bytes_sent)
+        metrics.count('bytes_received', self.bytes_received)
+        metrics.count('remote_commands')
+        l.debug("%r exited with %d after %.3f seconds, "
+                "%d bytes sent, %d bytes received",
+                self._command, self.exit_code, time() - self._start_time,
+                self.bytes_sent, self.bytes_received)
+        return self.exit_code
+
+    def run(self, o_buf):
+        """pump everything through, returning the exit code"""
+        while True:
+            data = self.read()
+            if len(data) == 0:
+                break
+            o_buf.write(data)
+        return self.finish()
+
+
+class ChannelReader(RawIOBase):
+    """
+    a read-only, unbuffered file object over the stdout of a remote command
+    that is still running. stderr is collected on the side, and when stdout
+    reaches EOF the exit code is checked - a non-zero exit code raises
+    RemoteCommandError from the read that hit the EOF.
+    """
+
+    def __init__(self, chan, command, i_buf=None):
+        super().__init__()
+        self._chan = chan
+        self._command = command
+        self._pump = ChannelPump(chan, command, i_buf)
+        self.e_buf = self._pump.e_buf
+        self.exit_code = None
+
+    def readable(self):
+        return True
+
+    @property
+    def bytes_received(self):
+        return self._pump.bytes_received
+
+    def readinto(self, buf):
+        if self.exit_code is not None:
+            return 0
+        data = self._pump.read(len(buf))
+        if len(data) == 0:
+            self._finish()
+            return 0
+        buf[:len(data)] = data
+        return len(data)
+
+    def _finish(self):
+        """stdout is done, check the exit code"""
+        self.exit_code = self._pump.finish()
+        if self.exit_code != 0 and not self._chan.get_transport().is_active():
+            l.debug("Lost the connection running %r", self._command)
+            raise ConnectionLostError("Lost the connection before the remote "
+                                      "command finished")
+        if self.exit_code != 0:
+            raise RemoteCommandError(
+                "{!r} exited with code {}: {}".format(
+                    self._command, self.exit_code,
+                    self.e_buf.getvalue().decode('utf-8', 'replace')))
+
+    def close(self):
+        if not self.closed:
+            self._chan.close()
+        super().close()
+
+
+# the remote end of RemoteAgent. Requests are a line, followed by a number
+# of text lines:
+#
+#   x {count}\n{count lines}        - run the lines as a shell command
+#   w {count} {path}\n{count lines} - write the lines to path
+#   q\n                             - quit
+#
+# and every request gets a response line followed by stdout and stderr:
+#
+#   r {exit code} {stdout size} {stderr size}\n{stdout}{stderr}
+AGENT_SCRIPT = r"""
+spool="$1"
+trap 'rm -f "$spool.out" "$spool.err"' EXIT
+exec 2>/dev/null
+read_lines() {
+    n=$1
+    while [ "$n" -gt 0 ]; do
+        IFS= read -r line
+        printf '%s\n' "$line"
+        n=$((n - 1))
+    done
+}
+while read -r op count path; do
+    case $op in
+    x)
+        command=$(read_lines "$count")
+        sh -c "$command" </dev/null >"$spool.out" 2>"$spool.err"
+        status=$?
+        ;;
+    w)
+        read_lines "$count" >"$path"
+        status=$?
+        : >"$spool.out"
+        : >"$spool.err"
+        ;;
+    q)
+        exit 0
+        ;;
+    *)
+        status=127
+        : >"$spool.out"
+        : >"$spool.err"
+        ;;
+    esac
+    printf 'r %d %d %d\n' "$status" $(wc -c <"$spool.out") \
+        $(wc -c <"$spool.err")
+    cat "$spool.out" "$spool.err"
+done
+"""
+
+
+class RemoteAgent:
+    """
+    runs many short commands and text file writes over a single channel,
+    with a small shell script on the remote end (see AGENT_SCRIPT). The
+    requests of a batch are all sent before the responses are read, so a
+    batch costs one round trip. The output of every command is spooled to
+    files starting with spool on the remote end, so it's no good for bulk
+    output - use exec_command_stream for that.
+    """
+
+    def __init__(self, client, spool):
+        self.spool = spool
+        self._chan = client.get_transport().open_session()
+        self._chan.exec_command("sh -c {} agent {}".format(
+            quote(AGENT_SCRIPT), quote(spool)))
+        self._responses = self._chan.makefile('rb')
+
+    @property
+    def alive(self):
+        return not (self._chan.closed or self._chan.exit_status_ready())
+
+    @staticmethod
+    def _lines(text):
+        """the text as lines ending with newlines, and their count"""
+        if isinstance(text, str):
+            text = text.encode('utf-8')
+        if not text.endswith(b'\n'):
+            text += b'\n'
+        return text, text.count(b'\n')
+
+    def request(self, *requests):
+        """
+        send the requests - ('x', command) or ('w', path, text) tuples - and
+        return a list of their (stdout, stderr, exit code) tuples
+        """
+        message = list()
+        for request in requests:
+            if request[0] == 'x':
+                text, count = self._lines(request[1])
+                message.append('x {}\n'.format(count).encode('ascii') + text)
+            elif request[0] == 'w':
+                text, count = self._lines(request[2])
+                message.append('w {} {}\n'.format(
+                    count, request[1]).encode('utf-8') + text)
+            else:
+                raise ValueError("Unknown request {!r}".format(request[0]))
+        start_time = time()
+        self._chan.sendall(b''.join(message))
+
+        responses = list()
+        with metrics.phase('remote_wait'):
+            for _request in requests:
+                header = self._responses.readline().split()
+                if len(header) != 4 or header[0] != b'r':
+                    raise RemoteCommandError(
+                        "Bad response from the agent: {!r}".format(header))
+                exit_code, out_size, err_size = map(int, header[1:])
+                responses.append((self._responses.read(out_size),
+                                  self._responses.read(err_size),
+                                  exit_code))
+        metrics.count('agent_requests', len(requests))
+        l.debug("Agent ran %d request(s) in %.3f seconds",
+                len(requests), time() - start_time)
+        return responses
+
+    def run(self, command):
+        """run a single command, returns (stdout, stderr, exit code)"""
+        return self.request(('x', command))[0]
+
+    def close(self):
+        if self.alive:
+            try:
+                self._chan.sendall(b'q\n')
+            except EOFError:
+                pass
+        self._chan.close()
+
+
 class DBSSHClient(SSHClient):
     """
     an SSH client, but with emulated file transfer to get over DropBear
@@ -50,69 +361,81 @@ class DBSSHClient(SSHClient):
         pipe input through a UNIX pipe on the remote end,
         returning the result
         """
-        # prepare for continuous feeding
         if o_buf is None:
             o_buf = BytesIO()
         if e_buf is None:
             e_buf = BytesIO()
-        i_event = Event()
-        o_event = Event()
-        e_event = Event()
-
-        def _blocking_loop(source_fun, dest_fun):
-            """main copy loop for a blocking copy"""
-            while True:
-                buf = source_fun(BUF_SIZE)
-                if len(buf) == 0:
-                    break
-                dest_fun(buf)
-
-        def _chan_sender(source, chan, event):
-            """
-            send everything in the buffer to the channel
-            then shut sending down
-            """
-            l.debug("sending to channel...")
-            _blocking_loop(source.read, chan.sendall)
-            l.debug("shutting channel write side")
-            chan.shutdown_write()
-            source.close()
-            event.set()
-
-        def _chan_receiver(chan_recv, dest, event):
-            """receive what we can from a channel until EOF"""
-            l.debug("Receiving from channel...")
-            _blocking_loop(chan_recv, dest.write)
-            l.debug("EOF encountered")
-            event.set()
-
-        # run the command
-        transport = self.get_transport()
-        chan = transport.open_session()
+
+        # run the command, feeding input and reading the outputs as they go
+        chan = self.get_transport().open_session()
+        try:
+            chan.exec_command(command)
+            exit_code = ChannelPump(chan, command, i_buf, e_buf).run(o_buf)
+        finally:
+            chan.close()
+
+        return o_buf, e_buf, exit_code
+
+    def exec_command_stream(self, command, i_buf=None):
+        """
+        run a command, feeding it i_buf (if any) as it goes and returning a
+        buffered file object to read its stdout from as it arrives.
+        See ChannelReader.
+        """
+        chan = self.get_transport().open_session()
         chan.exec_command(command)
+        return BufferedReader(ChannelReader(chan, command, i_buf),
+                              STREAM_BUF_SIZE)
 
-        # feed input, read from outputs
-        l.debug("new threads go!")
-        Thread(name="out", target=_chan_receiver,
-               args=(chan.recv, o_buf, o_event)).start()
-        Thread(name="err", target=_chan_receiver,
-               args=(chan.recv_stderr, o_buf, o_event)).start()
-        Thread(name="in", target=_chan_sender,
-               args=(i_buf, chan, i_event)).start()
+    def connect(self, *args, keepalive=0, **kwargs):
+        """
+        connect, sending keepalives every keepalive seconds (0 for none), and
+        remember the arguments for reconnect()
+        """
+        self._connect_args = (args, dict(kwargs, keepalive=keepalive))
+        super().connect(*args, **kwargs)
+        if keepalive:
+            self.get_transport().set_keepalive(keepalive)
 
-        # wait for them to finish
-        start_time = time()
-        while not chan.exit_status_ready():
-            i_event.wait(1.0)
-            o_event.wait(1.0)
-            e_event.wait(1.0)
-            if i_event.is_set() and o_event.is_set() and e_event.is_set():
-                break
-            l.debug("waiting %.3f seconds so far...", time() - start_time)
+    def reconnect(self):
+        """
+        connect again the way the last connect() did, e.g. after the
+        connection went away
+        """
+        args, kwargs = self._connect_args
+        self.close()
+        self.connect(*args, **kwargs)
+
+    def use_host_keys(self, host_keys):
+        """
+        check and add the host keys in a HostKeys shared with other clients
+        (see knownhosts.HostKeyStore) instead of the client's own - which
+        also means the missing host key policy doesn't save them
+        """
+        self._host_keys = host_keys
+        self._host_keys_filename = None
 
-        l.debug("execution time - %.3f seconds", time() - start_time)
+    def agent(self, spool):
+        """
+        the RemoteAgent of this client, started on first use (or after it
+        died), spooling to files starting with spool
+        """
+        agent = getattr(self, '_remote_agent', None)
+        if agent is None or not agent.alive or agent.spool != spool:
+            if agent is not None:
+                agent.close()
+            agent = self._remote_agent = RemoteAgent(self, spool)
+        return agent
 
-        return o_buf, e_buf, chan.recv_exit_status()
+    def close(self):
+        agent = getattr(self, '_remote_agent', None)
+        if agent is not None:
+            self._remote_agent = None
+            try:
+                agent.close()
+            except Exception:
+                pass
+        super().close()
 
     def exec_command_output_only(self, command, o_buf=None, e_buf=None):
         """
@@ -0,0 +1,181 @@
+'''
+Bulk parsing of the sum program's listings and of text tripwire databases.
+
+The input is read in large chunks of whole lines, and a chunk at a time
+goes through every stage of the pipeline that reads it - so the stages
+(and their metrics) cost a call per chunk rather than per line. A chunk is
+split on the separator of its first line, and the split is checked in
+bulk - the sums are all hex digits, and all as long, so no line was split
+on the wrong separator and none is escaped or a comment. Any other chunk is
+parsed by a single regular expression call. The lines are:
+
+{file_sum}{space}{space}{file_name}{EOL}       the sum program, text mode
+{file_sum}{space}*{file_name}{EOL}             the sum program, binary mode
+{file_sum}{tab}{file_name}{EOL}                the text database
+{file_sum}{tab}{size}{tab}{mtime}{tab}{ctime}{tab}{inode}{tab}
+    {file_name}{EOL}                           the text database, metadata
+
+The file name is everything up to the end of the line, whitespace included.
+The sum program escapes the names with a backslash or a newline in them
+(as \\\\ and \\n) and marks their lines with a leading backslash. The mark
+is dropped from the sum, but the name is kept escaped - so that it sorts,
+and hashes into directory digests (see merkle), the way it does on the
+remote end. Lines starting with a '#' are skipped.
+
+Usage:
+
+for chunk in iter_chunks(stream):
+    for file_name, file_sum, metadata in parse_chunk(chunk):
+        ...
+'''
+
+from operator import itemgetter
+import re
+
+import log
+l = log.getLogger(__name__)
+
+
+CHUNK_SIZE = 256 * 1024
+# lines per chunk, for streams that can only be iterated over
+LINE_BATCH = 8192
+LINE = re.compile(rb'^\\?([0-9a-fA-F]+)'
+                  rb'(?:\t(\d+)\t(\d+)\t(\d+)\t(\d+)\t|\t|  | \*)(.*)$',
+                  re.MULTILINE)
+FIRST_SUM = re.compile(rb'[0-9a-fA-F]+(  | \*|\t)')
+HEX_DIGITS = b'0123456789abcdefABCDEF'
+ESCAPE = re.compile(rb'\\[\\n]')
+UNESCAPED = {b'\\\\': b'\\', b'\\n': b'\n'}
+
+
+def iter_chunks(stream):
+    '''
+    yield the contents of the file object (or iterable of lines) in chunks
+    of whole lines, the last one with an EOL added if it's missing one
+    '''
+    read = getattr(stream, 'read', None)
+    if read is None:
+        lines = iter(stream)
+        while True:
+            batch = [line for _index, line in zip(range(LINE_BATCH), lines)]
+            if not batch:
+                return
+            yield _terminated(b''.join(batch))
+
+    rest = b''
+    while True:
+        data = read(CHUNK_SIZE)
+        if not data:
+            break
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            rest += data
+            continue
+        yield rest + data[:end]
+        rest = data[end:]
+    if rest:
+        yield _terminated(rest)
+
+
+def escape_name(name):
+    '''the file name as the sum program prints it'''
+    if b'\\' in name or b'\n' in name:
+        return name.replace(b'\\', b'\\\\').replace(b'\n', b'\\n')
+    return name
+
+
+def unescape_name(name):
+    '''the file name on the remote end, from its escape_name()'''
+    if b'\\' not in name:
+        return name
+    return ESCAPE.sub(lambda match: UNESCAPED[match.group(0)], name)
+
+
+def _terminated(chunk):
+    return chunk if chunk.endswith(b'\n') else chunk + b'\n'
+
+
+def _line_count(chunk):
+    '''the number of lines in the chunk that aren't comments'''
+    return (chunk.count(b'\n') - chunk.count(b'\n#') -
+            (1 if chunk.startswith(b'#') else 0))
+
+
+def _skip_comments(chunk):
+    '''the chunk without its leading comment lines'''
+    while chunk.startswith(b'#'):
+        chunk = chunk[chunk.find(b'\n') + 1:]
+    return chunk
+
+
+def _parse_uniform(chunk):
+    '''
+    parse a chunk of lines of the same shape - one separator per line, or
+    the database's five around the metadata, and no escapes or comments.
+    Returns None for any other chunk.
+    '''
+    first = FIRST_SUM.match(chunk)
+    if first is None:
+        return None
+    separator = first.group(1)
+    lines = chunk.split(b'\n')
+    lines.pop()
+    try:
+        if separator != b'\t':
+            # the name is everything after the first separator
+            entries = [(file_name, file_sum, None)
+                       for file_sum, file_name in (line.split(separator, 1)
+                                                   for line in lines)]
+        else:
+            # tabs are counted, as names may have some
+            tabs = chunk.count(b'\t')
+            if tabs == len(lines):
+                entries = [(file_name, file_sum, None)
+                           for file_sum, file_name in (line.split(b'\t')
+                                                       for line in lines)]
+            elif tabs == 5 * len(lines):
+                entries = [(file_name, file_sum, (size, mtime, ctime, inode))
+                           for file_sum, size, mtime, ctime, inode, file_name
+                           in (line.split(b'\t') for line in lines)]
+            else:
+                return None
+    except ValueError:
+        # a line without its separators, so another one has extra
+        return None
+    file_sums = list(map(itemgetter(1), entries))
+    if (len(set(map(len, file_sums))) != 1 or
+            b''.join(file_sums).translate(None, HEX_DIGITS)):
+        return None
+    return entries
+
+
+def parse_chunk(chunk):
+    '''
+    returns a list of (file_name, file_sum, metadata) tuples for the lines
+    in the chunk. metadata is a tuple of (size, mtime, ctime, inode), or
+    None when the line doesn't have it.
+    '''
+    chunk = _skip_comments(chunk)
+    entries = _parse_uniform(chunk)
+    if entries is not None:
+        return entries
+    matches = LINE.findall(chunk)
+    if len(matches) != _line_count(chunk):
+        # find the culprit, the slow way
+        for line in chunk.split(b'\n')[:-1]:
+            if not line.startswith(b'#'):
+                parse_line(line)
+        raise ValueError("Malformed lines in {!r}".format(chunk[:200]))
+    return [(file_name, file_sum,
+             (size, mtime, ctime, inode) if size else None)
+            for file_sum, size, mtime, ctime, inode, file_name in matches]
+
+
+def parse_line(line):
+    '''parse a single line, see parse_chunk'''
+    match = LINE.match(line.rstrip(b'\n'))
+    if match is None or b'\n' in line.rstrip(b'\n'):
+        raise ValueError("Malformed line {!r}".format(line))
+    file_sum, size, mtime, ctime, inode, file_name = match.groups()
+    return (file_name, file_sum,
+            (size, mtime, ctime, inode) if size else None)
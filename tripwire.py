@@ -9,139 +9,1129 @@ so that any change can be easily detected.
 
 '''
 
+import heapq
+from functools import partial
+from itertools import chain, compress, islice
+from operator import itemgetter, lt, not_
 import os
+from shutil import copyfileobj
+import sys
+from tempfile import TemporaryFile
+from threading import Lock, Thread
+from time import time
 
+from binarydb import (BinaryDatabase,
+                      DEFAULT_ALGORITHM,
+                      LayeredEntries,
+                      PackedEntries,
+                      is_binary_database,
+                      write_database)
+from extsort import external_sort
+from layers import LayerStore
 import log
+from merkle import MerkleTree, ROOT
+import metrics
+from sumparse import (CHUNK_SIZE, escape_name, iter_chunks, parse_chunk,
+                      parse_line, unescape_name)
 l = log.getLogger(__name__)
 
 
 DB_FILENAME_PATTERN = '{}.tripwire.db'
+BINARY_DB_FILENAME_PATTERN = '{}.tripwire.bdb'
+OVERLAY_FILENAME_PATTERN = '{}.tripwire.overlay'
+DB_FILENAME_PATTERNS = {
+    'text': DB_FILENAME_PATTERN,
+    'binary': BINARY_DB_FILENAME_PATTERN,
+    'layered': OVERLAY_FILENAME_PATTERN,
+}
+FULL_STAMP_PATTERN = '{}.tripwire.full'
+MERKLE_CACHE_PATTERN = '{}.tripwire.merkle'
+JOURNAL_PATTERN = '{}.tripwire.journal'
+HISTORY_PATTERN = '{}.tripwire.history'
+HASH_CHOICE_PATTERN = '{}.tripwire.hash'
+# the first line of a text database names its hash algorithm - databases
+# without it are sha256
+ALGORITHM_HEADER = b'# algorithm: '
+# the second line of a layered database names its layer
+LAYER_HEADER = b'# layer: '
+SECONDS_PER_DAY = 24 * 60 * 60
+BYTES_PER_MB = 1024 * 1024
 
 
-def _parse_database(db_file):
+def _iter_database(db_file):
+    '''
+    iterate over a database, or a listing of the sum program, made of lines
+    in the form:
+
+    {file_sum}{tab}{file_name}{EOL}
+
+    or, with the file metadata:
+
+    {file_sum}{tab}{size}{tab}{mtime}{tab}{ctime}{tab}{inode}{tab}
+        {file_name}{EOL}
+
+    (see sumparse for the rest) yielding (file_name, file_sum, metadata)
+    tuples. metadata is a tuple of (size, mtime, ctime, inode), or None when
+    the line doesn't have it. Header lines, starting with a '#', are skipped.
+    '''
+    for chunk in iter_chunks(db_file):
+        yield from parse_chunk(chunk)
+
+
+def _iter_stat_records(stats_stream):
+    '''
+    iterate over the remote file metadata listing, made of NUL terminated
+    records in the form:
+
+    {size} {mtime} {ctime} {inode} {file_name}\\0
+
+    yielding (file_name, metadata) tuples, the names escaped the way the sum
+    program escapes them
+    '''
+    rest = b''
+    for data in metrics.timed('decompress', iter(
+            partial(stats_stream.read, CHUNK_SIZE), b'')):
+        records = (rest + data).split(b'\0')
+        rest = records.pop()
+        for record in records:
+            size, mtime, ctime, inode, file_name = record.split(b' ', 4)
+            yield escape_name(file_name), (size, mtime, ctime, inode)
+    if rest:
+        raise ValueError("Truncated metadata record: {!r}".format(rest[:200]))
+
+
+def _iter_stats(stats_file):
     '''
-    parse a database made of lines in the form:
+    iterate over a file metadata listing made of lines in the form:
 
-    {file_sum}{whitespace}{file_name}{EOL}
+    {size} {mtime} {ctime} {inode} {file_name}{EOL}
+
+    the names escaped, yielding (file_name, metadata) tuples
+    '''
+    for line in stats_file:
+        size, mtime, ctime, inode, file_name = (
+            line.rstrip(b'\n').split(b' ', 4))
+        yield file_name, (size, mtime, ctime, inode)
 
-    returning a list of file names and a mapping of file_name --> file_sum
+
+def _parse_database(db_file):
+    '''
+    parse a database (see _iter_database), returning a list of file names
+    and a mapping of file_name --> file_sum
     '''
-    name_map = dict()
     names = list()
-    for line in db_file:
-        file_sum, file_name = line.strip().split()
-        name_map[file_name] = file_sum
-        names.append(file_name)
+    file_sums = list()
+    for chunk in iter_chunks(db_file):
+        entries = parse_chunk(chunk)
+        names.extend(map(itemgetter(0), entries))
+        file_sums.extend(map(itemgetter(1), entries))
+    return names, dict(zip(names, file_sums))
+
+
+def _check_sorted(entries):
+    '''pass tuples starting with a file name through, checking their order'''
+    previous = None
+    for entry in entries:
+        if previous is not None and entry[0] <= previous:
+            raise ValueError("Names out of order: {!r} after {!r}".format(
+                entry[0], previous))
+        previous = entry[0]
+        yield entry
+
+
+def _check_names_sorted(names, previous=()):
+    '''
+    check that the list of names is in order, and after the previous list's,
+    returns what to pass as previous for the next list
+    '''
+    names = list(previous) + names if previous else names
+    if not all(map(lt, names, islice(names, 1, None))):
+        # find the culprit, the slow way
+        list(_check_sorted((name,) for name in names))
+    return names[-1:]
+
+
+def _check_sorted_batches(batches):
+    '''_check_sorted, for lists of tuples'''
+    previous = ()
+    for batch in batches:
+        previous = _check_names_sorted(list(map(itemgetter(0), batch)),
+                                       previous)
+        yield batch
+
+
+def _same_sum(entry, db_entry):
+    return entry[1] == db_entry[1]
+
+
+def _iter_changes(entries, db_entries, same=_same_sum):
+    '''
+    compare two streams of (file_name, file_sum, ...) tuples, both sorted by
+    name, yielding (action, entry) tuples:
+
+    A - only in entries (added), with the entry
+    U - in both, but not the same (updated), with the entry
+    D - only in db_entries (deleted), with the db_entry
+    '''
+    entries, db_entries = iter(entries), iter(db_entries)
+    entry, db_entry = next(entries, None), next(db_entries, None)
+
+    # both streams are sorted, so this is a single O(n) pass
+    while entry is not None and db_entry is not None:
+        name, db_name = entry[0], db_entry[0]
+        if name == db_name:
+            if not same(entry, db_entry):
+                yield 'U', entry
+            entry, db_entry = next(entries, None), next(db_entries, None)
+        elif name > db_name:
+            yield 'D', db_entry
+            db_entry = next(db_entries, None)
+        else:
+            yield 'A', entry
+            entry = next(entries, None)
+    while entry is not None:
+        yield 'A', entry
+        entry = next(entries, None)
+    while db_entry is not None:
+        yield 'D', db_entry
+        db_entry = next(db_entries, None)
+
+
+def _merge_diff(entries, db_entries):
+    '''
+    compare two streams of (file_name, file_sum, ...) tuples, both sorted by
+    name, yielding (action, file_name) tuples - see _iter_changes
+    '''
+    for action, entry in _iter_changes(entries, db_entries):
+        yield action, entry[0]
+
+
+def _path_matcher(paths):
+    '''
+    returns a function telling if a file name is one of the paths (bytes),
+    or under one of them
+    '''
+    exact = frozenset(paths)
+    prefixes = tuple(path.rstrip(b'/') + b'/' for path in paths)
+    return lambda name: name in exact or name.startswith(prefixes)
+
+
+def _merge_stats(stats, sums, db_entries):
+    '''
+    combine the metadata listing, the sums of the files that were hashed and
+    the database into (file_name, file_sum, metadata) tuples. All three are
+    sorted by name. A file that was not hashed takes its sum from the
+    database, but only if its metadata is unchanged - otherwise the file
+    disappeared before it could be hashed, and is left out.
+    '''
+    stats, sums, db_entries = iter(stats), iter(sums), iter(db_entries)
+    stat, file_sum, db_entry = (next(stats, None), next(sums, None),
+                                next(db_entries, None))
+    while stat is not None or file_sum is not None:
+        if stat is None or (file_sum is not None and file_sum[0] < stat[0]):
+            # created after the listing - hashed, but no metadata
+            yield file_sum[0], file_sum[1], None
+            file_sum = next(sums, None)
+            continue
+
+        name, meta = stat
+        if file_sum is not None and file_sum[0] == name:
+            yield name, file_sum[1], meta
+            file_sum = next(sums, None)
+        else:
+            while db_entry is not None and db_entry[0] < name:
+                db_entry = next(db_entries, None)
+            if (db_entry is not None and db_entry[0] == name and
+                    db_entry[2] == meta):
+                yield name, db_entry[1], meta
+        stat = next(stats, None)
+
+
+def _write_text_database(db_file, entries, algorithm=DEFAULT_ALGORITHM):
+    '''
+    writes to the open file a database in the form:
+
+    # algorithm: {algorithm}{EOL}
+
+    {file_sum}{tab}{file_name}{EOL}
+
+    or, for the entries with metadata:
+
+    {file_sum}{tab}{size}{tab}{mtime}{tab}{ctime}{tab}{inode}{tab}
+        {file_name}{EOL}
+
+    from the (file_name, file_sum, metadata) tuples in order
+    '''
+    db_file.write(ALGORITHM_HEADER + algorithm.encode('ascii') + b'\n')
+    for entry in entries:
+        db_file.write(_text_line(entry))
+
+
+def _text_line(entry):
+    '''the text database line of a (file_name, file_sum, metadata) tuple'''
+    name, file_sum, meta = entry
+    if meta is None:
+        return file_sum + b'\t' + name + b'\n'
+    return b'\t'.join((file_sum,) + meta + (name,)) + b'\n'
+
+
+def _write_journal_segment(journal_file, changes, timestamp):
+    '''
+    append a segment of (action, entry) changes to the journal:
+
+    @{tab}{timestamp}{EOL}
+
+    then for every change
+
+    {action}{tab}{database line}{EOL}     for A and U, see _write_text_database
+    D{tab}{file_name}{EOL}
+    '''
+    journal_file.write('@\t{:.0f}\n'.format(timestamp).encode('ascii'))
+    for action, entry in changes:
+        if action == 'D':
+            journal_file.write(b'D\t' + entry[0] + b'\n')
+        else:
+            journal_file.write(action.encode('ascii') + b'\t' +
+                               _text_line(entry))
+
+
+def _load_journal(filename):
+    '''
+    replay the journal into a mapping of file_name --> the latest (file_name,
+    file_sum, metadata) tuple, or None for the deleted ones
+    '''
+    overlay = dict()
+    with open(filename, 'rb') as journal_file:
+        for line in journal_file:
+            action, rest = line[:1], line[2:]
+            if action in (b'@', b'#'):
+                continue
+            if action == b'D':
+                overlay[rest.rstrip(b'\n')] = None
+            else:
+                entry = parse_line(rest)
+                overlay[entry[0]] = entry
+    return overlay
+
+
+def _apply_journal(db_entries, overlay):
+    '''
+    merge the replayed journal (see _load_journal) over the sorted database
+    entries
+    '''
+    names = sorted(overlay)
+    index = 0
+    for entry in db_entries:
+        while index < len(names) and names[index] < entry[0]:
+            if overlay[names[index]] is not None:
+                yield overlay[names[index]]
+            index += 1
+        if index < len(names) and names[index] == entry[0]:
+            if overlay[names[index]] is not None:
+                yield overlay[names[index]]
+            index += 1
+        else:
+            yield entry
+    for name in names[index:]:
+        if overlay[name] is not None:
+            yield overlay[name]
+
+
+# appending to a journal and compacting it are serialised per journal file
+_journal_locks = dict()
+_journal_locks_lock = Lock()
+
+
+def _journal_lock(filename):
+    with _journal_locks_lock:
+        return _journal_locks.setdefault(os.path.abspath(filename), Lock())
+
+
+def _write_overlay(db_file, changes, algorithm, layer_filename):
+    '''
+    writes to the open file a layered database, the (action, entry) changes
+    from the layer as a journal segment after the header:
+
+    # algorithm: {algorithm}{EOL}
+    # layer: {layer_filename}{EOL}
+    '''
+    db_file.write(ALGORITHM_HEADER + algorithm.encode('ascii') + b'\n' +
+                  LAYER_HEADER + os.fsencode(layer_filename) + b'\n')
+    _write_journal_segment(db_file, changes, time())
+
+
+def overlay_layer(filename):
+    '''the layer of a layered database file, None for the other formats'''
+    try:
+        with open(filename, 'rb') as db_file:
+            db_file.readline()
+            line = db_file.readline()
+    except IOError:
+        return None
+    if not line.startswith(LAYER_HEADER):
+        return None
+    return os.fsdecode(line[len(LAYER_HEADER):].rstrip(b'\n'))
 
-    return names, name_map
+
+def _iter_database_file(filename):
+    '''
+    stream a database file of any format as (file_name, file_sum, metadata)
+    tuples
+    '''
+    layer_filename = overlay_layer(filename)
+    if layer_filename is not None:
+        yield from _apply_journal(_iter_database_file(layer_filename),
+                                  _load_journal(filename))
+    elif is_binary_database(filename):
+        with BinaryDatabase(filename) as db:
+            yield from db
+    else:
+        with open(filename, 'rb') as db_file:
+            for batch in _check_sorted_batches(
+                    map(parse_chunk, iter_chunks(db_file))):
+                yield from batch
+
+
+def database_algorithm(filename):
+    '''the name of the hash algorithm of a database file of either format'''
+    if is_binary_database(filename):
+        with BinaryDatabase(filename) as db:
+            return db.algorithm
+    with open(filename, 'rb') as db_file:
+        line = db_file.readline()
+    if line.startswith(ALGORITHM_HEADER):
+        return line[len(ALGORITHM_HEADER):].strip().decode('ascii')
+    return DEFAULT_ALGORITHM
+
+
+def _replace_file(filename, write_fun):
+    '''
+    write a file through write_fun(file_obj) into a temporary file next to
+    it, then rename it into place so that a failure half way through leaves
+    the previous version intact
+    '''
+    temp_filename = filename + '.tmp'
+    try:
+        with open(temp_filename, 'wb') as temp_file:
+            write_fun(temp_file)
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        raise
 
 
 class TripwireDatabase:
     '''
     maintain a 'tripwire' database - a list of "interesting" files and
-    their hash value for future comparison
+    their hash value for future comparison.
+
+    The remote sums and the database file are both streamed rather than
+    loaded into memory, so memory use does not grow with the size of the
+    remote filesystem.
+
+    With an incremental platform the database also keeps the size, mtime,
+    ctime and inode of every file. The remote end first sends that metadata,
+    and only the files that are new or whose metadata changed get hashed -
+    except every FULL_REHASH_DAYS, when everything is hashed again.
+
+    With a journaling platform an update only appends the changes to the
+    journal, a timestamped segment at a time, and the database is read as
+    the base file with the journal replayed over it. Once the journal grows
+    past JOURNAL_COMPACT_MB it is folded into a new base file in the
+    background, and moved to the history file.
+
+    With a priority platform the priority paths are scanned and compared
+    first, and the rest of the filesystem only after them - and with
+    FAIL_FAST a comparison stops, cancelling the remote command, at the
+    first difference.
+
+    With a resumable platform the remote scan runs detached from the
+    connection, and a dropped connection only means reconnecting and
+    reading the rest of its output (see platforms.ResumableSumsReader) -
+    the remote sums stream on as if it never happened.
+
+    With the layered format the database is only the changes from a
+    baseline layer, shared by the hosts built from the same image (see
+    layers). An update picks the layer closest to the host - its own if
+    it's still within LAYER_MAX_CHANGES percent - or adds the host's
+    database as a new layer if none is. The layer is memory mapped, so only
+    the changes take up memory, and disk, per host. Changes to the metadata
+    are changes too, so the incremental platforms share little.
+
+    The database records its hash algorithm. When the platform's algorithm
+    is a different one, the remote end is verified with the database's
+    algorithm, and the next update - which scans with the new one - rebuilds
+    the database with it. With the 'auto' algorithm the fastest one on the
+    host is picked by a benchmark, once per host.
     '''
     def __init__(self, client, host, platform):
         self._ssh_client = client
         self._platform = platform
         self._host = host
-        self._db_filename = DB_FILENAME_PATTERN.format(host)
+        self._db_format = platform.DB_FORMAT
+        self._db_filename = DB_FILENAME_PATTERNS[self._db_format].format(host)
         self._db_file_exists = os.path.exists(self._db_filename)
-        self._remote_names = self._remote_name_map = None
-        self._db_names = self._db_name_map = None
-
-        # try to load the database into memory
+        # read the database in the other format if that's all there is,
+        # the next update writes it in the configured one
+        self._db_read_filename = self._db_filename
+        if not self._db_file_exists:
+            for pattern in DB_FILENAME_PATTERNS.values():
+                if os.path.exists(pattern.format(host)):
+                    self._db_read_filename = pattern.format(host)
+                    self._db_file_exists = True
+                    l.info("Reading the database from %s",
+                           self._db_read_filename)
+        self._full_stamp_filename = FULL_STAMP_PATTERN.format(host)
+        self._journal_filename = JOURNAL_PATTERN.format(host)
+        self._history_filename = HISTORY_PATTERN.format(host)
+        self._hash_choice_filename = HASH_CHOICE_PATTERN.format(host)
+        self._db_algorithm = None
         if self._db_file_exists:
-            self._load_database()
+            self._db_algorithm = database_algorithm(self._db_read_filename)
+        # the platform the remote end is scanned with, see _pick_platforms()
+        self._scan_platform = platform
+        self._remote_entries = None
+        # the sums of the priority paths, streaming and once they're read
+        self._priority_entries = None
+        self._priority_list = None
+        self._is_excluded = platform.exclude_pattern().match
+        self._full_scan = True
+        self._merkle_pending = False
+        self._db_entries = None
 
-    def _write_database(self):
+    def _write_database(self, entries, algorithm):
         '''
-        writes to the file a database in the form:
-
-        {file_sum}{tab}{file_name}{EOL}
-
-        from the list of names in order, receiving file_sum from name_map
+        (re)writes the database file in the configured format from the
+        (file_name, file_sum, metadata) tuples in order, hashed with the
+        algorithm. The file is replaced only once it has been written in full.
         '''
         filename = self._db_filename
-        if self._db_file_exists:
+        if os.path.exists(filename):
             l.info("Updating database file %s", filename)
         else:
             l.info("Creating database file %s", filename)
 
-        with open(filename, 'wb') as db_file:
-            for name in self._db_names:
-                db_file.write(self._db_name_map[name] + b'\t' + name + b'\n')
+        if self._db_format == 'binary':
+            _replace_file(filename, lambda db_file: write_database(
+                db_file, entries, algorithm))
+        elif self._db_format == 'layered':
+            self._write_layered(entries, algorithm)
+        else:
+            _replace_file(filename, lambda db_file: _write_text_database(
+                db_file, entries, algorithm))
+        self._db_file_exists = True
+        self._db_algorithm = algorithm
+        self._db_read_filename = filename
+        self._db_entries = None
         return
 
+    def _write_layered(self, entries, algorithm):
+        '''
+        write the database as the changes from the closest layer, or as a
+        new layer if there is none close enough
+        '''
+        store = LayerStore(self._platform.LAYER_DIR)
+        spool_filename = store.spool_filename(self._host)
+        try:
+            _replace_file(spool_filename, lambda db_file: write_database(
+                db_file, entries, algorithm))
+            with BinaryDatabase(spool_filename) as db:
+                layer_filename, changes = self._closest_layer(store, db)
+            if layer_filename is None:
+                layer_filename, changes = store.add(spool_filename), []
+        finally:
+            if os.path.exists(spool_filename):
+                os.remove(spool_filename)
+        l.info("%s is %d changes from %s", self._host, len(changes),
+               layer_filename)
+        _replace_file(self._db_filename, lambda db_file: _write_overlay(
+            db_file, changes, algorithm, layer_filename))
+
+    def _closest_layer(self, store, db):
+        '''
+        the layer in the store with the fewest changes from the database,
+        and those changes - or None when every layer has too many. The
+        host's current layer is kept while it's within the limit.
+        '''
+        limit = len(db) * self._platform.LAYER_MAX_CHANGES // 100
+        current = overlay_layer(self._db_filename)
+        layers = store.layers(db.algorithm)
+        if current in layers:
+            layers.remove(current)
+            layers.insert(0, current)
+        best, best_changes = None, None
+        for layer_filename in layers:
+            with BinaryDatabase(layer_filename) as layer_db:
+                # metadata included, the overlay is to restore it exactly
+                changes = list(islice(_iter_changes(
+                    db, layer_db,
+                    lambda entry, db_entry: entry[1:] == db_entry[1:]),
+                    limit + 1))
+            if len(changes) > limit:
+                continue
+            best, best_changes = layer_filename, changes
+            if layer_filename == current or not changes:
+                break
+            # only a closer one from now on
+            limit = len(changes) - 1
+        if best is not None:
+            store.touch(best)
+        return best, best_changes
+
     def _load_database(self):
+        '''load the whole database into memory, packed'''
         if not self._db_file_exists:
             # no point in reading what's not there
             return
-        with open(self._db_filename, 'rb') as db_file:
-            self._db_names, self._db_name_map = _parse_database(db_file)
+        if (os.path.exists(self._journal_filename) or
+                is_binary_database(self._db_read_filename) or
+                overlay_layer(self._db_read_filename) is not None):
+            self._db_entries = PackedEntries(self._iter_db_files())
+            return
+        # straight from the parsed chunks
+        entries = PackedEntries()
+        previous = ()
+        with open(self._db_read_filename, 'rb') as db_file:
+            for batch in map(parse_chunk, iter_chunks(db_file)):
+                previous = _check_names_sorted(
+                    list(map(itemgetter(0), batch)), previous)
+                entries.extend(batch)
+        self._db_entries = entries
         return
 
-    def get_remote_sums(self):
-        '''get the file checksums from the remote server'''
+    def _iter_db(self):
+        '''stream the database as (file_name, file_sum, metadata) tuples'''
+        if self._db_entries is not None:
+            yield from self._db_entries
+        elif self._db_file_exists:
+            yield from self._iter_db_files()
+
+    def _iter_db_files(self):
+        '''
+        stream the database file, with the journal (if any) replayed over it.
+        The journal holds the latest state of every file it mentions, so
+        replaying it over a base it has already been folded into (during a
+        compaction) changes nothing.
+        '''
+        entries = _iter_database_file(self._db_read_filename)
+        try:
+            overlay = _load_journal(self._journal_filename)
+        except FileNotFoundError:
+            return entries
+        return _apply_journal(entries, overlay)
+
+    def _append_journal(self, entries):
+        '''append the changes between entries and the database as a segment'''
+        if self._platform.INCREMENTAL:
+            # keep the metadata current too, or the files would be rehashed
+            # on every incremental scan
+            changes = list(_iter_changes(
+                entries, self._iter_db(),
+                lambda entry, db_entry: entry[1:] == db_entry[1:]))
+        else:
+            changes = list(_iter_changes(entries, self._iter_db()))
+        if not changes:
+            l.info("No changes to journal")
+            return
+        with _journal_lock(self._journal_filename):
+            with open(self._journal_filename, 'ab') as journal_file:
+                _write_journal_segment(journal_file, changes, time())
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+        l.info("Journaled %d changes to %s", len(changes),
+               self._journal_filename)
+        self._db_entries = None
+
+        journal_size = os.path.getsize(self._journal_filename)
+        if journal_size >= self._platform.JOURNAL_COMPACT_MB * BYTES_PER_MB:
+            Thread(target=self._compact,
+                   name='compact-{}'.format(self._host)).start()
+
+    def _compact(self):
+        '''fold the journal into a new base file'''
+        with _journal_lock(self._journal_filename):
+            if not os.path.exists(self._journal_filename):
+                return
+            l.info("Compacting %s into %s", self._journal_filename,
+                   self._db_filename)
+            self._write_database(self._iter_db_files(), self._db_algorithm)
+            self._retire_journal()
+
+    def _retire_journal(self):
+        '''move the journal, now part of the base file, to the history'''
+        if not os.path.exists(self._journal_filename):
+            return
+        with open(self._journal_filename, 'rb') as journal_file, \
+                open(self._history_filename, 'ab') as history_file:
+            copyfileobj(journal_file, history_file)
+        os.remove(self._journal_filename)
+
+    def _full_rehash_due(self):
+        '''
+        has it been FULL_REHASH_DAYS since the last full scan that matched
+        (or created) the database
+        '''
+        if (not self._db_file_exists or
+                self._scan_platform.HASH_ALGORITHM != self._db_algorithm):
+            return True
+        try:
+            with open(self._full_stamp_filename, 'rt') as stamp_file:
+                last_full = float(stamp_file.read().strip())
+        except (IOError, ValueError):
+            return True
+        max_age = self._platform.FULL_REHASH_DAYS * SECONDS_PER_DAY
+        return time() - last_full >= max_age
+
+    def _stamp_full_scan(self):
+        '''remember that a full scan just matched the database'''
+        def _write_stamp(stamp_file):
+            stamp_file.write('{:.0f}\n'.format(time()).encode('ascii'))
+        _replace_file(self._full_stamp_filename, _write_stamp)
+
+    def _pick_algorithm(self):
+        '''
+        the fastest hash algorithm on the remote end. The benchmark runs once
+        per host, remove the host's .tripwire.hash file to run it again.
+        '''
+        name = self._picked_algorithm()
+        if name is not None:
+            return name
+        l.info("Benchmarking the hash algorithms on %s", self._host)
+        timings = self._platform.benchmark_hashes(self._ssh_client)
+        if not timings:
+            l.warning("No hash algorithm ran on %s, using %s", self._host,
+                      DEFAULT_ALGORITHM)
+            return DEFAULT_ALGORITHM
+        name = min(timings, key=timings.get)
+        l.info("Picked %s for %s", name, self._host)
+        _replace_file(self._hash_choice_filename,
+                      lambda choice_file: choice_file.write(
+                          name.encode('ascii') + b'\n'))
+        return name
+
+    def _picked_algorithm(self):
+        '''the algorithm the benchmark picked for the host, or None'''
+        try:
+            with open(self._hash_choice_filename, 'rt') as choice_file:
+                name = choice_file.read().strip()
+            if name in self._platform.HASH_ALGORITHMS:
+                return name
+        except IOError:
+            pass
+        return None
+
+    def offline_algorithm(self):
+        '''
+        the hash algorithm for a database built without the remote end - for
+        'auto' the one picked for the host if it was, or the default
+        '''
+        if self._platform.HASH_ALGORITHM != 'auto':
+            return self._platform.HASH_ALGORITHM
+        return self._picked_algorithm() or DEFAULT_ALGORITHM
+
+    def _pick_platforms(self, updating):
+        '''
+        settle the hash algorithm, and scan with the database's algorithm
+        for as long as the database hasn't been rebuilt with it - unless
+        updating, which rebuilds it
+        '''
+        if self._platform.HASH_ALGORITHM == 'auto':
+            self._platform = self._platform.configure(
+                dict(hash=self._pick_algorithm()))
+        self._scan_platform = self._platform
+        if (self._db_algorithm is not None and
+                self._db_algorithm != self._platform.HASH_ALGORITHM):
+            if self._db_algorithm not in self._platform.HASH_ALGORITHMS:
+                raise ValueError("Unknown hash algorithm {} in {}".format(
+                    self._db_algorithm, self._db_read_filename))
+            if updating:
+                l.info("Rebuilding the database of %s with %s", self._host,
+                       self._platform.HASH_ALGORITHM)
+                return
+            l.info("The database of %s is %s, verifying with it until the "
+                   "next update moves it to %s", self._host,
+                   self._db_algorithm, self._platform.HASH_ALGORITHM)
+            self._scan_platform = self._platform.configure(
+                dict(hash=self._db_algorithm))
+
+    def get_remote_sums(self, updating=False):
+        '''
+        start getting the file checksums from the remote server, for an
+        update_database() if updating - or else for compare_databases()
+        '''
+        self._pick_platforms(updating)
+        self._start_remote_sums()
+
+    def _start_remote_sums(self):
+        '''start the scan of the remote end, with the scan platform'''
+        platform = self._scan_platform
+        if platform.INCREMENTAL:
+            l.debug("Requesting remote file metadata")
+            stats_stream = platform.get_remote_stats(self._ssh_client)
+            if stats_stream is None:
+                raise IOError("Could not retrieve file metadata from "
+                              "{}".format(self._host))
+            self._full_scan = self._full_rehash_due()
+            self._remote_entries = self._iter_remote_incremental(stats_stream)
+            return
+
+        if platform.MERKLE:
+            l.debug("Requesting remote sums into the remote spool")
+            if not platform.merkle_scan(self._ssh_client):
+                platform.merkle_cleanup(self._ssh_client)
+                raise IOError("Could not retrieve sums from {}".format(
+                    self._host))
+            self._full_scan = True
+            self._merkle_pending = True
+            self._remote_entries = self._iter_merkle_sums()
+            return
+
+        self._full_scan = True
+        priority_paths = platform.priority_paths() if platform.PRIORITY else ()
+        if priority_paths:
+            l.debug("Requesting remote sums of %d priority paths",
+                    len(priority_paths))
+            sums_stream = platform.get_remote_sums(self._ssh_client,
+                                                   roots=priority_paths)
+            if sums_stream is None:
+                raise IOError("Could not retrieve sums from {}".format(
+                    self._host))
+            self._priority_entries = self._iter_sums(sums_stream)
+            self._priority_list = None
+            self._remote_entries = self._iter_tiered(priority_paths)
+            return
 
         l.debug("Requesting remote sums")
-        sums_stream = self._platform.get_remote_sums(self._ssh_client)
-
-        l.debug("Parsing the results")
-        names, name_map = _parse_database(sums_stream)
-        names.sort()
-
-        l.debug("Removing excluded names")
-        clean_names = list()
-        for name in names:
-            if any(
-                    [pat.match(name)
-                     for pat
-                     in self._platform.EXCLUDE_PATTERNS]
-            ):
-                del name_map[name]
-            else:
-                clean_names.append(name)
+        sums_stream = platform.get_remote_sums(self._ssh_client)
+        if sums_stream is None:
+            raise IOError("Could not retrieve sums from {}".format(
+                self._host))
+        self._remote_entries = self._iter_sums(sums_stream)
+
+    def _iter_tiered(self, priority_paths):
+        '''
+        the sums of the priority paths, merged with the sums of everything
+        else - which are only requested once the priority ones are in
+        '''
+        priority = self._priority_list
+        if priority is None:
+            priority = list(self._priority_entries)
+        self._priority_entries = self._priority_list = None
+        l.debug("Requesting remote sums of the rest")
+        sums_stream = self._scan_platform.get_remote_sums(
+            self._ssh_client, prune=priority_paths)
+        if sums_stream is None:
+            raise IOError("Could not retrieve sums from {}".format(
+                self._host))
+        yield from _check_sorted(heapq.merge(
+            priority, self._iter_sums(sums_stream), key=itemgetter(0)))
 
-        self._remote_names = clean_names
-        self._remote_name_map = name_map
+    def _priority_differences(self):
+        '''
+        compare the sums of the priority paths to the database, keeping them
+        for the rest of the comparison
+        '''
+        is_priority = _path_matcher(
+            [os.fsencode(path)
+             for path in self._scan_platform.priority_paths()])
+        collected = list()
 
-    def compare_databases(self):
-        '''Compare the database to the received names'''
+        def _collect(entries):
+            for entry in entries:
+                collected.append(entry)
+                yield entry
+
+        entries, self._priority_entries = self._priority_entries, None
+        diff = self._collect_differences(_merge_diff(
+            _collect(entries),
+            (entry for entry in self._iter_db() if is_priority(entry[0]))))
+        if diff:
+            l.error("The priority paths of %s differ", self._host)
+        else:
+            l.info("The %d files in the priority paths of %s match",
+                   len(collected), self._host)
+        self._priority_list = collected
+        return diff
+
+    def _collect_differences(self, differences):
+        '''
+        the (action, file_name) tuples as a list - with FAIL_FAST only the
+        first one, closing the remote streams behind them
+        '''
         diff = list()
-        idx, db_idx = 0, 0
-        names, db_names = self._remote_names, self._db_names  # short names
-        name_map, db_name_map = self._remote_name_map, self._db_name_map
-        size, db_size = len(names), len(db_names)
-
-        # assuming both names and db_names are sorted for an O(n) comparison
-        # (but paid O(log n) to do the sorting)
-        while (idx < size) and (db_idx < db_size):
-            name, db_name = names[idx], db_names[db_idx]
-            if name == db_name:
-                if name_map[name] != db_name_map[db_name]:
-                    diff.append(('U', name))
-                idx += 1
-                db_idx += 1
-            elif name > db_name:
-                diff.append(('D', db_name))
-                db_idx += 1
+        try:
+            for change in differences:
+                diff.append(change)
+                if self._platform.FAIL_FAST:
+                    l.warning("Stopping at the first difference")
+                    break
+        finally:
+            close = getattr(differences, 'close', None)
+            if close is not None:
+                close()
+        return diff
+
+    def _iter_sums(self, sums_stream):
+        '''
+        parse the remote sums and remove the excluded names as they arrive,
+        yielding (file_name, file_sum, None) tuples
+        '''
+        l.debug("Parsing the results and removing excluded names")
+        is_excluded = self._is_excluded
+        try:
+            # a chunk of lines at a time
+            batches = metrics.timed('parse', map(
+                parse_chunk, metrics.timed('decompress',
+                                           iter_chunks(sums_stream))))
+            batches = metrics.timed('filter', (
+                list(compress(batch, map(not_, map(is_excluded, map(
+                    itemgetter(0), batch))))) for batch in batches))
+            if self._platform.REMOTE_SORT:
+                for batch in _check_sorted_batches(batches):
+                    yield from batch
             else:
-                diff.append(('A', name))
-                idx += 1
-        while (idx < size):
-            name = names[idx]
-            diff.append(('A', name))
-            idx += 1
-        while (db_idx < db_size):
-            db_name = db_names[db_idx]
-            diff.append(('D', db_name))
-            db_idx += 1
+                yield from _check_sorted(self._sorted(
+                    chain.from_iterable(batches)))
+        finally:
+            sums_stream.close()
+
+    def _sorted(self, entries):
+        '''
+        the entries from the remote end, sorted by name - they are already,
+        unless the platform sorts locally
+        '''
+        if self._platform.REMOTE_SORT:
+            return entries
+        return metrics.timed('sort', external_sort(
+            entries, self._platform.SORT_MEMORY_MB * BYTES_PER_MB))
+
+    def _iter_remote_incremental(self, stats_stream):
+        '''
+        read the remote metadata listing, hash what needs hashing, and yield
+        (file_name, file_sum, metadata) tuples
+        '''
+        # the listing is kept in a local temporary file between the passes
+        with TemporaryFile() as spool:
+            needs_sum = list()
+            total = 0
+            db_entries = iter(()) if self._full_scan else self._iter_db()
+            db_entry = next(db_entries, None)
+            try:
+                # escaping the names changes their order, so they are
+                # sorted here even when the remote end sorted them already
+                stats = _check_sorted(metrics.timed('sort', external_sort(
+                    metrics.timed('parse', _iter_stat_records(stats_stream)),
+                    self._platform.SORT_MEMORY_MB * BYTES_PER_MB)))
+                for name, meta in stats:
+                    if self._is_excluded(name):
+                        continue
+                    total += 1
+                    spool.write(b' '.join(meta + (name,)) + b'\n')
+                    if self._full_scan:
+                        continue
+                    while db_entry is not None and db_entry[0] < name:
+                        db_entry = next(db_entries, None)
+                    # any change, including of ctime alone, means a rehash
+                    if (db_entry is None or db_entry[0] != name or
+                            db_entry[2] != meta):
+                        needs_sum.append(unescape_name(name))
+            finally:
+                stats_stream.close()
+            del db_entries
+
+            metrics.count('files_hashed',
+                          total if self._full_scan else len(needs_sum))
+            sums = iter(())
+            if self._full_scan or needs_sum:
+                if self._full_scan:
+                    l.info("Full rehash of %d files", total)
+                    sums_stream = self._scan_platform.get_remote_sums(
+                        self._ssh_client)
+                else:
+                    l.info("%d of %d files changed, hashing them",
+                           len(needs_sum), total)
+                    sums_stream = self._scan_platform.get_remote_sums(
+                        self._ssh_client, needs_sum)
+                if sums_stream is None:
+                    raise IOError("Could not retrieve sums from {}".format(
+                        self._host))
+                sums = self._iter_sums(sums_stream)
+            else:
+                l.info("None of the %d files changed", total)
+            del needs_sum
+
+            spool.seek(0)
+            db_entries = iter(()) if self._full_scan else self._iter_db()
+            yield from _merge_stats(_iter_stats(spool), sums, db_entries)
+
+    def _iter_merkle_sums(self):
+        '''stream all of the remote spool, then clean it up'''
+        self._merkle_pending = False
+        try:
+            yield from self._iter_sums(
+                self._scan_platform.merkle_sums(self._ssh_client))
+        finally:
+            self._scan_platform.merkle_cleanup(self._ssh_client)
+
+    def _merkle_tree(self):
+        '''
+        returns a directory digest tree over the database, and the object to
+        close once done with it
+        '''
+        algorithm = self._scan_platform.hash_algorithm()[1]
+        if not self._db_file_exists:
+            return MerkleTree(PackedEntries(), algorithm=algorithm), None
+        db_stat = os.stat(self._db_read_filename)
+        cache_key = '{} {} {}'.format(os.path.basename(self._db_read_filename),
+                                      db_stat.st_size,
+                                      db_stat.st_mtime_ns).encode('utf-8')
+        cache_filename = MERKLE_CACHE_PATTERN.format(self._host)
+        if os.path.exists(self._journal_filename):
+            journal_stat = os.stat(self._journal_filename)
+            cache_key += ' {} {}'.format(
+                journal_stat.st_size, journal_stat.st_mtime_ns).encode('utf-8')
+        elif is_binary_database(self._db_read_filename):
+            entries = BinaryDatabase(self._db_read_filename)
+            return MerkleTree(entries, cache_filename, cache_key,
+                              algorithm), entries
+        elif overlay_layer(self._db_read_filename) is not None:
+            layer_db = BinaryDatabase(overlay_layer(self._db_read_filename))
+            entries = LayeredEntries(layer_db,
+                                     _load_journal(self._db_read_filename))
+            return MerkleTree(entries, cache_filename, cache_key,
+                              algorithm), layer_db
+        if self._db_entries is None:
+            self._load_database()
+        return MerkleTree(self._db_entries, cache_filename, cache_key,
+                          algorithm), None
+
+    def _merkle_differences(self):
+        '''
+        compare directory digests with the remote end, starting at the root
+        and descending only into the directories that differ. Returns the
+        same (action, file_name) tuples as the full comparison.
+        '''
+        platform, client = self._scan_platform, self._ssh_client
+        self._merkle_pending = False
+        self._remote_entries = None
+        tree, to_close = self._merkle_tree()
+        try:
+            remote_root = platform.merkle_root(client)
+            if remote_root == tree.digest(ROOT):
+                l.debug("Root digests match")
+                return list()
+
+            diff = list()
+            level = [ROOT]
+            while level:
+                l.debug("Comparing %d directories", len(level))
+                answers = platform.merkle_children(client, level)
+                next_level = list()
+                for prefix in level:
+                    remote_dirs, remote_files = answers[prefix]
+                    local_files, local_dirs = tree.children(prefix)
+                    remote_files = [entry for entry in remote_files
+                                    if not self._is_excluded(entry[0])]
+                    diff.extend(_merge_diff(remote_files, local_files))
+                    local_dirs = set(local_dirs)
+                    for child in sorted(local_dirs.union(remote_dirs)):
+                        if child not in local_dirs:
+                            diff.extend(
+                                ('A', name) for name, _file_sum
+                                in platform.merkle_subtree(client, child)
+                                if not self._is_excluded(name))
+                        elif child not in remote_dirs:
+                            diff.extend(('D', name) for name, _file_sum
+                                        in tree.entries_under(child))
+                        elif remote_dirs[child] != tree.digest(child):
+                            next_level.append(child)
+                level = next_level
+
+            with metrics.phase('sort'):
+                diff.sort(key=itemgetter(1))
+            return diff
+        finally:
+            tree.save()
+            if to_close is not None:
+                to_close.close()
+            platform.merkle_cleanup(client)
+
+    def _iter_remote(self):
+        '''
+        the remote (file_name, file_sum, metadata) tuples, sorted by name.
+        Can only be consumed once.
+        '''
+        entries, self._remote_entries = self._remote_entries, None
+        if entries is None:
+            raise ValueError("Remote sums not requested or already consumed")
+        return entries
+
+    def iter_differences(self):
+        '''
+        compare the database to the remote sums as they arrive, yielding
+        (action, file_name) tuples
+        '''
+        if self._merkle_pending:
+            return iter(self._merkle_differences())
+        return _merge_diff(self._iter_remote(), self._iter_db())
 
+    def compare_databases(self):
+        '''Compare the database to the received names.'''
+        with metrics.phase('compare'):
+            diff = list()
+            if self._priority_entries is not None:
+                diff = self._priority_differences()
+            if not (diff and self._platform.FAIL_FAST):
+                diff = self._collect_differences(self.iter_differences())
+        if self._full_scan and len(diff) == 0 and self._platform.INCREMENTAL:
+            self._stamp_full_scan()
         return diff
 
     def update_database(self):
         '''(re)write the database file with the data from the remote server'''
-        self._db_names = self._remote_names
-        self._db_name_map = self._remote_name_map
-        self._write_database()
+        with metrics.phase('db_write'):
+            if (self._platform.JOURNAL and self._db_file_exists and
+                    self._db_read_filename == self._db_filename and
+                    self._db_algorithm == self._scan_platform.HASH_ALGORITHM):
+                self._append_journal(self._iter_remote())
+            else:
+                with _journal_lock(self._journal_filename):
+                    self._write_database(self._iter_remote(),
+                                         self._scan_platform.HASH_ALGORITHM)
+                    self._retire_journal()
+        if self._full_scan and self._platform.INCREMENTAL:
+            self._stamp_full_scan()
+
+    def import_database(self, entries, algorithm):
+        '''
+        (re)write the database file from (file_name, file_sum, metadata)
+        tuples sorted by name, hashed with the algorithm - e.g. from a copy
+        of the host's filesystem, see baseline
+        '''
+        with metrics.phase('db_write'), _journal_lock(self._journal_filename):
+            self._write_database(entries, algorithm)
+            self._retire_journal()
+
+
+def convert_database(source, destination, db_format):
+    '''
+    convert a database file of either format into the given format, e.g.
+    to import or export the text format
+    '''
+    algorithm = database_algorithm(source)
+    if db_format == 'binary':
+        _replace_file(destination, lambda db_file: write_database(
+            db_file, _iter_database_file(source), algorithm))
+    elif db_format == 'text':
+        _replace_file(destination, lambda db_file: _write_text_database(
+            db_file, _iter_database_file(source), algorithm))
+    else:
+        raise ValueError("Unknown database format {}".format(db_format))
+
+
+if __name__ == '__main__':
+    # python tripwire.py {text|binary} source destination
+    convert_database(sys.argv[2], sys.argv[3], sys.argv[1])
@@ -0,0 +1,237 @@
+'''
+Watch the hosts, and verify and unlock every one of them as soon as it
+reboots into its initramfs.
+
+Every host's SSH port is probed on a schedule, reading only the banner the
+server sends when the connection opens - no key exchange, no login. A host
+whose banner is its platform's INITRAMFS_BANNER (dropbear) is waiting for
+its password, and is run right away. The schedule backs off while a host
+can't be reached, with jitter so that the probes of a fleet spread out.
+
+The hosts are run on a worker thread, a batch at a time, while the probes
+go on. A host is run once per boot: after a run that unlocked it, or
+found it changed, it's left alone until it's seen out of its initramfs -
+with another banner, or unreachable DOWN_PROBES times in a row. A run that
+failed on an error, such as a connection that couldn't be made or went
+away, is retried, backing off like the probes. The configuration file is
+reloaded when it changes.
+
+Usage:
+
+watch('safestart.conf', load_hosts, run_hosts, interval=10)
+'''
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import socket
+from time import sleep, time
+
+import fleet
+import log
+l = log.getLogger(__name__)
+
+
+SSH_PORT = 22
+PROBE_TIMEOUT = 5.0
+PROBE_WORKERS = 16
+MAX_BANNER = 256
+# seconds between probes, backing off to MAX_INTERVAL while a host is down
+INTERVAL = 10.0
+MAX_INTERVAL = 300.0
+JITTER = 0.25
+DOWN_PROBES = 3
+
+
+def probe_banner(host, port=SSH_PORT, timeout=PROBE_TIMEOUT):
+    '''the SSH banner of the host, or None if it can't be reached'''
+    data = b''
+    try:
+        with socket.create_connection((host, port), timeout) as sock:
+            while b'\n' not in data and len(data) < MAX_BANNER:
+                chunk = sock.recv(MAX_BANNER)
+                if not chunk:
+                    break
+                data += chunk
+    except OSError as exc:
+        l.debug("Probing %s: %s", host, exc)
+        return None
+    return data.split(b'\n', 1)[0].strip().decode('ascii', 'replace') or None
+
+
+class HostState:
+    '''what the watcher knows about a host'''
+    def __init__(self):
+        self.next_probe = 0.0
+        self.failures = 0
+        self.banner = None
+        # run during this boot already
+        self.handled = False
+        # being run, and the runs that failed on an error in a row
+        self.running = False
+        self.run_failures = 0
+
+
+class Watcher:
+    '''
+    probes the hosts loaded by load_hosts() (HostConfig tuples) and passes
+    the ones that rebooted to run_hosts(hosts_config)
+    '''
+    def __init__(self, config_file, load_hosts, run_hosts, interval=INTERVAL):
+        self._config_file = config_file
+        self._load_hosts = load_hosts
+        self._run_hosts = run_hosts
+        self._interval = interval
+        self._config_stamp = None
+        self._hosts = list()
+        self._states = dict()
+        # one run at a time, off the probing
+        self._executor = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='run')
+        self._runs = list()
+
+    def _reload(self):
+        '''(re)load the configuration file if it changed'''
+        try:
+            stat = os.stat(self._config_file)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            # missing, there's no telling when it changes - load it once
+            stamp = 0
+        if stamp == self._config_stamp:
+            return
+        try:
+            hosts = self._load_hosts()
+        except Exception:
+            l.exception("Could not load %s, keeping the previous hosts",
+                        self._config_file)
+            return
+        self._config_stamp = stamp
+        self._hosts = hosts
+        self._states = dict((host_config.host,
+                             self._states.get(host_config.host, HostState()))
+                            for host_config in hosts)
+        l.info("Watching %d hosts from %s", len(hosts), self._config_file)
+
+    def _schedule(self, state, now):
+        '''
+        set the next probe, backing off while the host is down or its runs
+        fail
+        '''
+        delay = min(MAX_INTERVAL, self._interval *
+                    2 ** (state.failures + state.run_failures))
+        state.next_probe = now + delay * random.uniform(1 - JITTER, 1 + JITTER)
+
+    def _needs_run(self, host_config, banner):
+        '''update the host's state with a probe, True if it's to be run'''
+        state = self._states[host_config.host]
+        if banner != state.banner:
+            l.info("%s: %s", host_config.host, banner or "unreachable")
+        state.banner = banner
+        if banner is None:
+            state.failures += 1
+            if state.failures >= DOWN_PROBES:
+                state.handled = False
+                state.run_failures = 0
+            return False
+        state.failures = 0
+        if host_config.platform.INITRAMFS_BANNER not in banner:
+            state.handled = False
+            state.run_failures = 0
+            return False
+        return not (state.handled or state.running)
+
+    def _collect_runs(self):
+        '''take in the results of the runs that are done'''
+        runs = list()
+        for future, hosts_config in self._runs:
+            if not future.done():
+                runs.append((future, hosts_config))
+                continue
+            try:
+                results = dict((result.host, result)
+                               for result in future.result())
+            except Exception:
+                l.exception("Running %s failed", ", ".join(
+                    host_config.host for host_config in hosts_config))
+                results = dict()
+            for host_config in hosts_config:
+                self._finish_run(host_config.host,
+                                 results.get(host_config.host))
+        self._runs = runs
+
+    def _finish_run(self, host, result):
+        '''
+        the host is handled if it was unlocked, updated or found changed -
+        otherwise its run failed on an error and it's run again later
+        '''
+        state = self._states.get(host)
+        if state is None:
+            # no longer in the configuration
+            return
+        state.running = False
+        if result is not None and (
+                result.status in (fleet.UNLOCKED, fleet.UPDATED) or
+                (result.status == fleet.FAILED and not result.raised)):
+            state.handled = True
+            state.run_failures = 0
+            return
+        state.run_failures += 1
+        self._schedule(state, time())
+        l.warning("%s: run failed, trying again in %.0f seconds", host,
+                  state.next_probe - time())
+
+    def sweep(self):
+        '''
+        probe the hosts that are due and run the ones that rebooted,
+        returns the seconds until the next probe is due
+        '''
+        self._reload()
+        self._collect_runs()
+        now = time()
+        due = [host_config for host_config in self._hosts
+               if self._states[host_config.host].next_probe <= now]
+        if due:
+            with ThreadPoolExecutor(max_workers=PROBE_WORKERS) as executor:
+                banners = list(executor.map(
+                    lambda host_config: probe_banner(host_config.host), due))
+            to_run = [host_config
+                      for host_config, banner in zip(due, banners)
+                      if self._needs_run(host_config, banner)]
+            if to_run:
+                l.info("Running %s", ", ".join(host_config.host
+                                               for host_config in to_run))
+                for host_config in to_run:
+                    self._states[host_config.host].running = True
+                self._runs.append((self._executor.submit(self._run_hosts,
+                                                         to_run), to_run))
+            now = time()
+            for host_config in due:
+                self._schedule(self._states[host_config.host], now)
+        # the configuration file is checked at least every interval
+        next_probe = min([state.next_probe for state in self._states.values()]
+                         + [time() + self._interval])
+        return max(0.0, next_probe - time())
+
+    def run(self):
+        '''sweep until interrupted, then wait for the run in progress'''
+        try:
+            while True:
+                sleep(self.sweep())
+        finally:
+            for future, _hosts_config in self._runs:
+                future.cancel()
+            if any(future.running() for future, _hosts_config in self._runs):
+                l.info("Waiting for the hosts being run")
+            self._executor.shutdown()
+
+
+def watch(config_file, load_hosts, run_hosts, interval=INTERVAL):
+    '''run a Watcher until interrupted, see Watcher'''
+    l.info("Watching for rebooted hosts, probing every %.0f seconds",
+           interval)
+    try:
+        Watcher(config_file, load_hosts, run_hosts, interval).run()
+    except KeyboardInterrupt:
+        l.info("Stopped watching")
+    return 0